@@ -1,40 +1,129 @@
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from dotenv import load_dotenv
-from apscheduler.schedulers.background import BackgroundScheduler
-from apscheduler.schedulers.base import SchedulerNotRunningError
+from datetime import datetime, timedelta
+import atexit
+import click
 import os
-from .entsoe import update_entsoe_data
-from .netkosten import fetch_region_prices
+import random
+import threading
+from .entsoe import load_entsoe_snapshot
+from .netkosten import load_netkosten_snapshot
+from .metrics import init_metrics
 
 load_dotenv()
 
 db = SQLAlchemy()
 
-def create_app():
+# local: this process fetches ENTSO-E and netkosten itself
+# shared: a separate `python -m app.refresher` writes the snapshots and this process only reloads them
+REFRESH_MODE = os.getenv('REFRESH_MODE', 'local')
+# With FAST_BOOT=1 create_app skips schema creation (run `flask init` once instead) and loads the
+# snapshots and price cache in the background, so a new worker accepts requests right away; /ready
+# reports when it is warmed up
+FAST_BOOT = os.getenv('FAST_BOOT', '0') == '1'
+# Longest wait between fast-boot warm-up attempts, in seconds
+WARM_UP_RETRY_MAX = 60
+
+
+def init_schema():
+    from .queries import ensure_indexes, normalize_jaar
+    db.create_all()
+    ensure_indexes()
+    normalize_jaar()
+
+
+def warm_up(app):
+    from .price_cache import check_import, rebuild_price_cache
+    load_entsoe_snapshot()
+    load_netkosten_snapshot()
+    check_import(app)
+    rebuild_price_cache(app)
+
+
+def init_commands(app):
+    @app.cli.command('init')
+    @click.option('--fetch', is_flag=True, help='Fetch ENTSO-E prices and grid costs before building the cache.')
+    def init(fetch):
+        """Create the schema and warm up the snapshots and price ranks once."""
+        with app.app_context():
+            init_schema()
+        if fetch:
+            from .entsoe import update_entsoe_data
+            from .netkosten import fetch_region_prices
+            update_entsoe_data()
+            fetch_region_prices()
+        warm_up(app)
+        click.echo('Initialized.')
+
+
+def create_app(serve=True):
     app = Flask(__name__)
     app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('DATABASE_URI')
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
     db.init_app(app)
+    init_metrics(app)
+    init_commands(app)
 
     with app.app_context():
         from . import routes
-        db.create_all()
-        update_entsoe_data()
-        fetch_region_prices()
+        if serve and not FAST_BOOT:
+            init_schema()
+
+    if not serve:
+        # `flask --app "app:create_app(serve=False)" init`: no background jobs
+        return app
+
+    from apscheduler.schedulers.background import BackgroundScheduler
+    from apscheduler.schedulers.base import SchedulerNotRunningError
+    from .price_cache import rebuild_price_cache, check_import
+    from .refresher import add_refresh_jobs, reload_snapshots
+
+    def refresh_price_cache():
+        rebuild_price_cache(app)
+
+    def reload_shared_snapshots():
+        if reload_snapshots():
+            refresh_price_cache()
 
     scheduler = BackgroundScheduler()
-    scheduler.add_job(update_entsoe_data, 'interval', hours=1)
-    scheduler.add_job(fetch_region_prices, 'interval', days=1)
-    scheduler.start()
 
-    @app.teardown_appcontext
-    def shutdown_session(exception=None):
+    def start_warm_up(attempt=0):
+        # Start from the last snapshots on disk; the network refresh runs in the background
+        try:
+            warm_up(app)
+        except Exception as e:
+            if not FAST_BOOT:
+                raise
+            # Retry soon with backoff rather than leave the worker unready until a scheduled rebuild
+            delay = min(WARM_UP_RETRY_MAX, 2 ** attempt) * random.uniform(0.5, 1.0)
+            print(f"Warm-up failed, retrying in {delay:.0f}s: {e}")
+            scheduler.add_job(start_warm_up, 'date', run_date=datetime.now() + timedelta(seconds=delay),
+                              kwargs={'attempt': attempt + 1}, id='warm-up', replace_existing=True)
+
+    def start():
+        start_warm_up()
+        if REFRESH_MODE == 'shared':
+            scheduler.add_job(reload_shared_snapshots, 'interval', seconds=30)
+        else:
+            add_refresh_jobs(scheduler, on_refresh=refresh_price_cache)
+        scheduler.add_job(rebuild_price_cache, 'cron', minute=0, args=[app])
+        scheduler.add_job(check_import, 'interval', minutes=5, args=[app])
+        scheduler.start()
+
+    if FAST_BOOT:
+        threading.Thread(target=start, name='warm-up', daemon=True).start()
+    else:
+        start()
+
+    def shutdown_scheduler():
         try:
             if scheduler.running:
                 scheduler.shutdown()
         except SchedulerNotRunningError:
             print("Scheduler was not running.")
 
+    atexit.register(shutdown_scheduler)
+
     return app
@@ -0,0 +1,44 @@
+import os
+import threading
+from functools import wraps
+from flask import Response, request, jsonify
+
+from .response_cache import response_cache, request_key, STALE_WARNING
+
+
+# Concurrent show_prices computations per process, and how long a request may wait for a slot
+PRICING_CONCURRENCY = int(os.getenv('PRICING_CONCURRENCY', os.cpu_count() or 2))
+PRICING_QUEUE_TIMEOUT = float(os.getenv('PRICING_QUEUE_TIMEOUT', 2))
+RETRY_AFTER = 5
+
+pricing_slots = threading.BoundedSemaphore(PRICING_CONCURRENCY)
+
+
+def overloaded():
+    # Fall back on the last response rendered for the same query, even if the data has moved on since
+    cached = response_cache.get_stale(request_key())
+    if cached is not None:
+        response = Response(cached[0], mimetype=cached[1])
+        response.headers['Warning'] = STALE_WARNING
+        return response
+    response = jsonify({'error': 'Too many price calculations in progress, try again shortly'})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(RETRY_AFTER)
+    return response
+
+
+def admission_control(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        # GET requests only compute prices with show_prices; POST endpoints always do
+        if request.method == 'GET' and not request.args.get('show_prices'):
+            return view(*args, **kwargs)
+        if not pricing_slots.acquire(timeout=PRICING_QUEUE_TIMEOUT):
+            return overloaded()
+        try:
+            # Streamed bodies are priced batch by batch while they are written and take a slot per
+            # batch then (see stream_query), so the slot is not held for the body's lifetime
+            return view(*args, **kwargs)
+        finally:
+            pricing_slots.release()
+    return wrapper
@@ -1,61 +1,278 @@
 import os
+import re
 import requests
 import xml.etree.ElementTree as ET
 from dotenv import load_dotenv
 from datetime import datetime, timedelta
+import numpy as np
 import pytz
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+
+from .snapshots import save_series, load_series
+from .metrics import span, increment
 
 
 ENTSOE_API_URL = os.getenv('ENTSOE_API_URL')
 ENTSOE_API_KEY = os.getenv('ENTSOE_API_KEY')
 LOCAL_TIMEZONE = pytz.timezone('Europe/Brussels')
+REQUEST_TIMEOUT = 30
 
-def fetch_entsoe_data():
-    current_date = datetime.now(pytz.UTC)
-    period_start = current_date.strftime('%Y%m%d0000')
-    period_end = (current_date + timedelta(days=1)).strftime('%Y%m%d0000')
-    
-    url = f"{ENTSOE_API_URL}periodStart={period_start}&periodEnd={period_end}&securityToken=af42286a-cd40-4df2-85d1-ade8083fb4fc"
-    response = requests.get(url)
-    
-    if response.status_code != 200:
-        print(f"Failed to fetch data: {response.status_code}")
-        return None
+# Bidding zone -> (EIC area code, local timezone)
+BIDDING_ZONES = {
+    'BE': ('10YBE----------2', 'Europe/Brussels'),
+    'NL': ('10YNL----------L', 'Europe/Amsterdam'),
+    'FR': ('10YFR-RTE------C', 'Europe/Paris'),
+    'DE_LU': ('10Y1001A1001A82H', 'Europe/Berlin'),
+    'AT': ('10YAT-APG------L', 'Europe/Vienna'),
+    'CH': ('10YCH-SWISSGRIDZ', 'Europe/Zurich'),
+    'PL': ('10YPL-AREA-----S', 'Europe/Warsaw'),
+    'CZ': ('10YCZ-CEPS-----N', 'Europe/Prague'),
+    'ES': ('10YES-REE------0', 'Europe/Madrid'),
+    'PT': ('10YPT-REN------W', 'Europe/Lisbon'),
+    'DK1': ('10YDK-1--------W', 'Europe/Copenhagen'),
+    'DK2': ('10YDK-2--------M', 'Europe/Copenhagen'),
+    'NO1': ('10YNO-1--------2', 'Europe/Oslo'),
+    'SE3': ('10Y1001A1001A46L', 'Europe/Stockholm'),
+    'SE4': ('10Y1001A1001A47J', 'Europe/Stockholm'),
+    'FI': ('10YFI-1--------U', 'Europe/Helsinki'),
+}
+DEFAULT_ZONE = 'BE'
+# Zones kept in the history store, e.g. ENTSOE_ZONES=BE,NL,FR,DE_LU
+ENTSOE_ZONES = [zone.strip() for zone in os.getenv('ENTSOE_ZONES', DEFAULT_ZONE).split(',') if zone.strip() in BIDDING_ZONES]
+FETCH_WORKERS = int(os.getenv('ENTSOE_FETCH_WORKERS', 8))
+
+session = requests.Session()
+session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=FETCH_WORKERS))
+# Days before today that the history store is kept filled for: a year, so the default /simulate
+# window (the year up to today) is covered. Only missing ranges are fetched after the first backfill.
+ENTSOE_HISTORY_DAYS = int(os.getenv('ENTSOE_HISTORY_DAYS', 366))
+# ENTSO-E serves at most a year per request; smaller ranges keep a failed backfill cheap to retry
+FETCH_RANGE_HOURS = 31 * 24
+RESOLUTION_PATTERN = re.compile(r'PT(\d+)([MH])')
+
+def zone_url(zone):
+    # ENTSOE_API_URL with the in/out domain set to the zone's area code
+    area = BIDDING_ZONES[zone][0]
+    url = ENTSOE_API_URL or ''
+    url = url if re.search(r'[?&]$', url) else url + '&'
+    url = re.sub(r'(in|out)_Domain=[^&]*&', '', url)
+    return f"{url}in_Domain={area}&out_Domain={area}&"
+
+def fetch_entsoe_data(start, end, zone=DEFAULT_ZONE):
+    # Returns (epoch_hour, price) arrays, or None when the request failed
+    period_start = start.astimezone(pytz.UTC).strftime('%Y%m%d%H00')
+    period_end = end.astimezone(pytz.UTC).strftime('%Y%m%d%H00')
     
-    root = ET.fromstring(response.content)
-    data = parse_entsoe_data(root)
-    return data
-
-def parse_entsoe_data(root):
-    data = []
-    for period in root.findall(".//{*}Period"):
-        time_interval = period.find("{*}timeInterval")
-        start_utc = datetime.strptime(time_interval.find("{*}start").text, '%Y-%m-%dT%H:%MZ').replace(tzinfo=pytz.UTC)
-        
-        for point in period.findall("{*}Point"):
-            position = int(point.find("{*}position").text)
-            price = point.find("{*}price.amount").text
-
-            hour_start_utc = start_utc + timedelta(hours=position-1)
-            hour_end_utc = hour_start_utc + timedelta(hours=1)
-
-            hour_start_local = hour_start_utc.astimezone(LOCAL_TIMEZONE).strftime('%Y-%m-%dT%H:%M:%S%z')
-            hour_end_local = hour_end_utc.astimezone(LOCAL_TIMEZONE).strftime('%Y-%m-%dT%H:%M:%S%z')
-            
-            data.append({
-                'start': hour_start_local,
-                'end': hour_end_local,
-                'position': position,
-                'price': price
-            })
-    return data
-
-entsoe_data = []
-
-def get_entsoe_data():
-    global entsoe_data
-    return entsoe_data
-
-def update_entsoe_data():
-    global entsoe_data
-    entsoe_data = fetch_entsoe_data()
+    url = f"{zone_url(zone)}periodStart={period_start}&periodEnd={period_end}&securityToken={ENTSOE_API_KEY or ''}"
+    try:
+        with session.get(url, timeout=REQUEST_TIMEOUT, stream=True) as response:
+            if response.status_code != 200:
+                print(f"Failed to fetch data: {response.status_code}")
+                return None
+            # Parse while the body is downloaded instead of holding the document in memory
+            response.raw.decode_content = True
+            return parse_entsoe_data(response.raw)
+    except requests.RequestException as e:
+        print(f"Failed to fetch data: {e}")
+    except ET.ParseError as e:
+        print(f"Failed to parse data: {e}")
+    return None
+
+def _epoch_minute(text):
+    return int(datetime.strptime(text, '%Y-%m-%dT%H:%MZ').replace(tzinfo=pytz.UTC).timestamp()) // 60
+
+def _resolution_minutes(text):
+    match = RESOLUTION_PATTERN.fullmatch(text.strip())
+    if match is None:
+        raise ET.ParseError(f"Unsupported resolution {text}")
+    return int(match.group(1)) * (60 if match.group(2) == 'H' else 1)
+
+def _period_slots(start, end, resolution, positions, prices):
+    # Epoch minute and price of every slot in a Period. Positions left out (curve type A03)
+    # repeat the price of the previous point.
+    count = (end - start) // resolution if end is not None else max(positions)
+    if count <= 0:
+        return np.empty(0, dtype=np.int64), np.empty(0)
+    values = np.full(count, np.nan)
+    positions = np.asarray(positions) - 1
+    inside = positions < count
+    values[positions[inside]] = np.asarray(prices)[inside]
+    known = ~np.isnan(values)
+    values = values[np.maximum.accumulate(np.where(known, np.arange(count), 0))]
+    values[:np.argmax(known)] = np.nan
+    return start + np.arange(count) * resolution, values
+
+def parse_entsoe_data(source):
+    # Streams a day-ahead price document (file object or path) into (epoch_hour, price) arrays.
+    # Works for any number of days; sub-hourly resolutions such as PT15M are averaged per hour.
+    minutes, prices = [], []
+    start = end = resolution = position = None
+    period_positions, period_prices = [], []
+    for _, element in ET.iterparse(source, events=('end',)):
+        tag = element.tag.rpartition('}')[2]
+        if tag == 'position':
+            position = int(element.text)
+        elif tag == 'price.amount':
+            period_positions.append(position)
+            period_prices.append(float(element.text))
+        elif tag == 'start':
+            start = _epoch_minute(element.text)
+        elif tag == 'end':
+            end = _epoch_minute(element.text)
+        elif tag == 'resolution':
+            resolution = _resolution_minutes(element.text)
+        elif tag == 'Period':
+            if period_positions:
+                slot_minutes, slot_prices = _period_slots(start, end, resolution, period_positions, period_prices)
+                minutes.append(slot_minutes)
+                prices.append(slot_prices)
+            period_positions, period_prices = [], []
+            end = None
+            element.clear()
+        elif tag in ('Point', 'TimeSeries'):
+            element.clear()
+
+    if not minutes:
+        return np.empty(0, dtype=np.int64), np.empty(0)
+    minutes = np.concatenate(minutes)
+    prices = np.concatenate(prices)
+    known = ~np.isnan(prices)
+    hours, slots = np.unique(minutes[known] // 60, return_inverse=True)
+    return hours, np.bincount(slots, prices[known]) / np.bincount(slots)
+
+def epoch_hour(moment):
+    return int(moment.timestamp()) // 3600
+
+def hour_start(hour):
+    return datetime.fromtimestamp(hour * 3600, pytz.UTC)
+
+def zone_timezone(zone=DEFAULT_ZONE):
+    return pytz.timezone(BIDDING_ZONES[zone][1])
+
+def local_day_start(day, days=0, timezone=LOCAL_TIMEZONE):
+    # Midnight in the zone's timezone (Brussels by default), `days` after the given date
+    return timezone.localize(datetime(day.year, day.month, day.day) + timedelta(days=days))
+
+class HourlyPrices:
+    # Read-only history of day-ahead prices as a dense array indexed by UTC epoch hour, NaN where unknown.
+    # The array may be a memory map of the shared snapshot file; updates build a new instance with merged().
+
+    def __init__(self, first_hour=0, prices=None):
+        self.first_hour = first_hour
+        self.prices = prices if prices is not None else np.empty(0)
+
+    def __len__(self):
+        return int(np.count_nonzero(~np.isnan(self.prices)))
+
+    def get(self, hour, default=None):
+        i = hour - self.first_hour
+        if 0 <= i < len(self.prices) and not np.isnan(self.prices[i]):
+            return float(self.prices[i])
+        return default
+
+    def window(self, first_hour, hours):
+        values = np.full(hours, np.nan)
+        start = max(first_hour, self.first_hour)
+        end = min(first_hour + hours, self.first_hour + len(self.prices))
+        if start < end:
+            values[start - first_hour:end - first_hour] = self.prices[start - self.first_hour:end - self.first_hour]
+        return values
+
+    def missing_ranges(self, first_hour, end_hour):
+        # [(start, end)) runs of hours in [first_hour, end_hour) without a known price
+        known = ~np.isnan(self.window(first_hour, end_hour - first_hour))
+        edges = np.flatnonzero(np.diff(np.concatenate([[True], known, [True]])))
+        return [(first_hour + int(start), first_hour + int(end)) for start, end in zip(edges[::2], edges[1::2])]
+
+    def merged(self, hours, prices):
+        # New store with the given (epoch_hour, price) pairs written over this one
+        hours = np.asarray(hours, dtype=np.int64)
+        if not len(hours):
+            return self
+        first_hour = int(hours.min())
+        end_hour = int(hours.max()) + 1
+        if len(self.prices):
+            first_hour = min(first_hour, self.first_hour)
+            end_hour = max(end_hour, self.first_hour + len(self.prices))
+        values = self.window(first_hour, end_hour - first_hour)
+        values[hours - first_hour] = prices
+        return HourlyPrices(first_hour, values)
+
+
+# zone -> HourlyPrices; the dict and its series are replaced as a whole on every update.
+# entsoe_updated_at is the latest publication over all zones.
+entsoe_prices = {}
+entsoe_updated_at = None
+NO_PRICES = HourlyPrices()
+_publish_lock = threading.Lock()
+
+def get_entsoe_prices(zone=DEFAULT_ZONE):
+    # Zones without data share one empty series, so identity checks such as price_cache.covers() still hold
+    prices = entsoe_prices.get(zone)
+    return NO_PRICES if prices is None else prices
+
+def get_entsoe_range(start, end, zone=DEFAULT_ZONE):
+    # Hourly prices for [start, end) from the local store, NaN where unknown; never calls ENTSO-E
+    first_hour = epoch_hour(start)
+    return first_hour, get_entsoe_prices(zone).window(first_hour, max(epoch_hour(end) - first_hour, 0))
+
+def publish_entsoe_prices(prices, fetched_at, zone=DEFAULT_ZONE):
+    global entsoe_prices
+    global entsoe_updated_at
+    with _publish_lock:
+        entsoe_prices = dict(entsoe_prices, **{zone: prices})
+        entsoe_updated_at = max(fetched_at, entsoe_updated_at or 0)
+
+def series_name(zone):
+    # The default zone keeps the original snapshot name
+    return 'entsoe' if zone == DEFAULT_ZONE else f'entsoe-{zone}'
+
+def load_entsoe_snapshot(zones=None):
+    loaded = False
+    for zone in zones or ENTSOE_ZONES:
+        first_hour, values, fetched_at = load_series(series_name(zone))
+        if values is not None:
+            publish_entsoe_prices(HourlyPrices(first_hour, values), fetched_at, zone)
+            loaded = True
+    return loaded
+
+def update_zone(zone, history_days):
+    # Only the hours missing between `history_days` ago and the end of tomorrow are requested.
+    # Tomorrow stays missing until the day-ahead auction is published.
+    timezone = zone_timezone(zone)
+    today = datetime.now(timezone)
+    first_hour = epoch_hour(local_day_start(today, -history_days, timezone))
+    end_hour = epoch_hour(local_day_start(today, 2, timezone))
+
+    prices = get_entsoe_prices(zone)
+    hours, values = [], []
+    complete = True
+    for start, end in prices.missing_ranges(first_hour, end_hour):
+        for chunk in range(start, end, FETCH_RANGE_HOURS):
+            with span('entsoe_fetch'):
+                data = fetch_entsoe_data(hour_start(chunk), hour_start(min(chunk + FETCH_RANGE_HOURS, end)), zone)
+            increment('entsoe_requests_total', zone=zone, result='failed' if data is None else 'ok')
+            if data is None:
+                complete = False
+                continue
+            hours.append(data[0])
+            values.append(data[1])
+
+    if hours:
+        with span('entsoe_store'):
+            prices = prices.merged(np.concatenate(hours), np.concatenate(values))
+            fetched_at = time.time()
+            publish_entsoe_prices(prices, fetched_at, zone)
+            save_series(series_name(zone), prices.first_hour, prices.prices, fetched_at)
+    return complete
+
+def update_entsoe_data(history_days=ENTSOE_HISTORY_DAYS):
+    # Zones are fetched concurrently over the shared session
+    if not ENTSOE_ZONES:
+        return True
+    with ThreadPoolExecutor(max_workers=min(FETCH_WORKERS, len(ENTSOE_ZONES))) as pool:
+        results = list(pool.map(lambda zone: update_zone(zone, history_days), ENTSOE_ZONES))
+    return all(results)
@@ -0,0 +1,125 @@
+import os
+import time
+import threading
+from flask import g, request, has_request_context
+
+
+# Timing spans and counters for the hot paths, exposed on /metrics in the Prometheus text format.
+# With METRICS_ENABLED=0 a span is a shared no-op and nothing is recorded.
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', '1') == '1'
+# Requests sending this header get their stage breakdown back in a Server-Timing header
+PROFILE_HEADER = 'X-Profile'
+
+# stage -> [count, total seconds]
+stage_stats = {}
+# (name, labels) -> value
+counters = {}
+_lock = threading.Lock()
+
+
+class Span:
+    __slots__ = ('name', 'started')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        record_stage(self.name, time.perf_counter() - self.started)
+        return False
+
+
+class NoSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NO_SPAN = NoSpan()
+
+
+def span(name):
+    return Span(name) if METRICS_ENABLED else NO_SPAN
+
+
+def record_stage(name, seconds):
+    with _lock:
+        stats = stage_stats.setdefault(name, [0, 0.0])
+        stats[0] += 1
+        stats[1] += seconds
+    if has_request_context():
+        profile = g.get('profile')
+        if profile is not None:
+            profile.append((name, seconds))
+
+
+def increment(name, value=1, **labels):
+    if not METRICS_ENABLED:
+        return
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        counters[key] = counters.get(key, 0) + value
+
+
+def init_metrics(app):
+    if not METRICS_ENABLED:
+        return
+
+    @app.before_request
+    def start_request():
+        g.request_started = time.perf_counter()
+        if request.headers.get(PROFILE_HEADER):
+            g.profile = []
+
+    @app.after_request
+    def finish_request(response):
+        started = g.get('request_started')
+        if started is None:
+            return response
+        seconds = time.perf_counter() - started
+        record_stage(f'request:{request.endpoint}', seconds)
+        increment('http_responses_total', endpoint=request.endpoint or '', status=str(response.status_code))
+        profile = g.get('profile')
+        if profile is not None:
+            stages = [f'{name.replace(":", "_")};dur={duration * 1000:.2f}' for name, duration in profile
+                      if not name.startswith('request:')]
+            response.headers['Server-Timing'] = ', '.join(stages + [f'total;dur={seconds * 1000:.2f}'])
+        return response
+
+
+def _labels(labels):
+    return '{' + ','.join(f'{name}="{value}"' for name, value in labels) + '}' if labels else ''
+
+
+def render_metrics(gauges=()):
+    # `gauges` are (name, labels dict, value) computed at scrape time, such as data ages
+    lines = ['# TYPE stage_seconds summary']
+    with _lock:
+        stages = sorted(stage_stats.items())
+        values = sorted(counters.items())
+    for name, (count, total) in stages:
+        lines.append(f'stage_seconds_sum{{stage="{name}"}} {total:.6f}')
+        lines.append(f'stage_seconds_count{{stage="{name}"}} {count}')
+
+    typed = set()
+    for (name, labels), value in values:
+        if name not in typed:
+            lines.append(f'# TYPE {name} counter')
+            typed.add(name)
+        lines.append(f'{name}{_labels(labels)} {value}')
+    # Samples of one metric have to stay together
+    for name, labels, value in sorted(gauges, key=lambda gauge: gauge[0]):
+        if value is None:
+            continue
+        if name not in typed:
+            lines.append(f'# TYPE {name} gauge')
+            typed.add(name)
+        lines.append(f'{name}{_labels(sorted(labels.items()))} {value}')
+    return '\n'.join(lines) + '\n'
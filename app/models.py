@@ -33,6 +33,9 @@ class Data(db.Model):
 
     __table_args__ = (
         db.UniqueConstraint('jaar', 'maand', 'handelsnaam', 'productnaam', 'prijsonderdeel', name='_data_uc'),
+        # Match the /data filter combinations: a period plus product type, or a product type on its own
+        db.Index('ix_data_period_type', 'jaar', 'maand', 'vast_variabel_dynamisch', 'energietype'),
+        db.Index('ix_data_type', 'vast_variabel_dynamisch', 'energietype', 'contracttype'),
     )
 
     def to_dict(self):
@@ -67,3 +70,27 @@ class Data(db.Model):
             'vaste_vergoeding_tweevoudige_meter': self.vaste_vergoeding_tweevoudige_meter,
             'vaste_vergoeding_uitsluitend_nachttarief': self.vaste_vergoeding_uitsluitend_nachttarief
         }
+
+
+class ImportLog(db.Model):
+    __tablename__ = 'import_log'
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    imported_at = db.Column(db.DateTime)
+
+
+class PriceRank(db.Model):
+    __tablename__ = 'price_rank'
+
+    data_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    today_avg = db.Column(db.Float, index=True)
+    regional = db.Column(db.Boolean)
+
+
+class PriceRankState(db.Model):
+    # What the shared price_rank table was last written for: a single row
+    __tablename__ = 'price_rank_state'
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    hour = db.Column(db.String(13))
+    version = db.Column(db.String(64))
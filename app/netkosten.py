@@ -1,6 +1,12 @@
+import multiprocessing
 import requests
-import pandas as pd
+import time
 from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from requests.adapters import HTTPAdapter
+
+from .snapshots import save_json, load_json
+from .metrics import span
 
 REGIONS_URLS_AFNAME = [
     {"Fluvius Antwerpen": "https://www.fluvius.be/sites/fluvius/files/2023-12/distributienettarieven-elektriciteit-afname-fluvius-antwerpen-01012024-31122024.xlsx"},
@@ -17,49 +23,130 @@ REGIONS_URLS_AFNAME = [
 
 ZIPCODE_DATA_URL = "https://opendata.fluvius.be/api/explore/v2.1/catalog/datasets/1_23-dnb-per-gemeente-en-per-sector/exports/json?lang=en&timezone=Europe%2FBrussels"
 
-zipcode_data = {}
-tarieven = []
+REQUEST_TIMEOUT = 30
+PARSE_WORKERS = 4
+
+session = requests.Session()
+session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=len(REGIONS_URLS_AFNAME)))
+
+# url -> ETag / Last-Modified of the last successfully parsed download
+validators = {}
+
+# (postcode -> region, region -> tariff per month), replaced as a whole by fetch_region_prices
+netkosten_index = ({}, {})
+netkosten_updated_at = None
+
+def publish_netkosten(zip_regions, tarieven, fetched_at):
+    global netkosten_index
+    global netkosten_updated_at
+    netkosten_index = (zip_regions, tarieven)
+    netkosten_updated_at = fetched_at
+
+def load_netkosten_snapshot():
+    data, fetched_at = load_json('netkosten')
+    if data is None:
+        return False
+    validators.update(data['validators'])
+    publish_netkosten(data['zipcodes'], {name: tuple(prices) if prices else None for name, prices in data['tarieven'].items()}, fetched_at)
+    return True
+
+def conditional_get(url, known):
+    headers = {}
+    cached = validators.get(url, {}) if known else {}
+    if cached.get("etag"):
+        headers["If-None-Match"] = cached["etag"]
+    if cached.get("last_modified"):
+        headers["If-Modified-Since"] = cached["last_modified"]
+    try:
+        return session.get(url, headers=headers, timeout=REQUEST_TIMEOUT)
+    except requests.RequestException as e:
+        print(f"Failed to fetch {url}: {e}")
+        return None
+
+def remember_validators(url, response):
+    validators[url] = {
+        "etag": response.headers.get("ETag"),
+        "last_modified": response.headers.get("Last-Modified")
+    }
+
+def parse_tariff_workbook(content):
+    # pandas is only needed here, so serving processes that never refresh don't load it
+    import pandas as pd
+    xls = pd.ExcelFile(BytesIO(content))
+    df = xls.parse(xls.sheet_names[0])
+    return tuple(df.iloc[45:57, 16].tolist())
+
+def parse_tariff_workbooks(contents):
+    if len(contents) == 1:
+        return [parse_tariff_workbook(contents[0])]
+    # Forkserver (or spawn) workers start clean rather than forking the threaded server mid-request
+    method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+    with ProcessPoolExecutor(max_workers=min(PARSE_WORKERS, len(contents)), mp_context=multiprocessing.get_context(method)) as pool:
+        return list(pool.map(parse_tariff_workbook, contents))
 
 def fetch_region_prices():
-    global tarieven
-    global zipcode_data
-    for region in REGIONS_URLS_AFNAME:
-        for name, url in region.items():
-            response = requests.get(url)
-            if response.status_code == 200:
-                xls = pd.ExcelFile(BytesIO(response.content))
-                df = xls.parse(xls.sheet_names[0])
-                prices = df.iloc[45:58, 16].tolist()
-                tarieven.append({name: prices})
-            else:
-                tarieven.append({name: None})
+    # Returns False when any source could not be refreshed; what did come in is published regardless
+    zip_regions, tarieven = netkosten_index
+    complete = True
+    regions = [(name, url) for region in REGIONS_URLS_AFNAME for name, url in region.items()]
+
+    with span('netkosten_download'), ThreadPoolExecutor(max_workers=len(regions)) as pool:
+        responses = list(pool.map(lambda region: conditional_get(region[1], region[0] in tarieven), regions))
+
+    new_tarieven = {}
+    downloaded = []
+    for (name, url), response in zip(regions, responses):
+        if response is not None and response.status_code == 200:
+            downloaded.append((name, url, response))
+        else:
+            new_tarieven[name] = tarieven.get(name)
+            if response is None or response.status_code != 304:
+                complete = False
                 print(f"Failed to fetch data for {name} from {url}")
 
-    response = requests.get(ZIPCODE_DATA_URL)
-    if response.status_code == 200:
-        zipcode_data = response.json()
-        return zipcode_data
-    else:
+    if downloaded:
+        try:
+            with span('netkosten_parse'):
+                parsed = parse_tariff_workbooks([response.content for _, _, response in downloaded])
+        except Exception as e:
+            print(f"Failed to parse tariff workbooks: {e}")
+            complete = False
+            parsed = [tarieven.get(name) for name, _, _ in downloaded]
+        else:
+            for _, url, response in downloaded:
+                remember_validators(url, response)
+        for (name, _, _), prices in zip(downloaded, parsed):
+            new_tarieven[name] = prices
+
+    with span('netkosten_zipcodes'):
+        response = conditional_get(ZIPCODE_DATA_URL, bool(zip_regions))
+    if response is not None and response.status_code == 200:
+        zip_regions = {}
+        for row in response.json():
+            zip_regions[str(row["postcode"]).strip()] = row["dnb_elektriciteit"]
+        remember_validators(ZIPCODE_DATA_URL, response)
+    elif response is None or response.status_code != 304:
+        complete = False
         print(f"Failed to fetch data from {ZIPCODE_DATA_URL}")
-        return None
-    
+
+    fetched_at = time.time()
+    publish_netkosten(zip_regions, new_tarieven, fetched_at)
+    save_json('netkosten', {'zipcodes': zip_regions, 'tarieven': new_tarieven, 'validators': validators}, fetched_at)
+    return complete
+
 
 from datetime import datetime
 
+def get_region_cost(region, tarieven=None, month=None):
+    if not region:
+        return 0
+    if tarieven is None:
+        _, tarieven = netkosten_index
+    prices = tarieven.get(region)
+    if not prices:
+        return 0
+    return prices[(month or datetime.now().month) - 1]
+
 def get_cost_from_zip(zip=None):
-    global tarieven
-    global zipcode_data
-    region = ""
-    price = 0
-
-    current_month = datetime.now().month
-    
-    for row in zipcode_data:
-        if row["postcode"] == zip:
-            region = row["dnb_elektriciteit"]
-
-    for row in tarieven:
-        if region in row:
-            price = row[region][current_month - 1]
-
-    return price
+    zip_regions, tarieven = netkosten_index
+    return get_region_cost(zip_regions.get((zip or "").strip(), ""), tarieven)
@@ -0,0 +1,149 @@
+import hashlib
+import threading
+import time
+import numpy as np
+from datetime import timezone
+
+from . import db
+from .models import Data, ImportLog, PriceRank, PriceRankState
+from .entsoe import DEFAULT_ZONE
+from .metrics import span, increment
+from .pricing import PRICING_COLUMNS, pricing_date, pricing_context, to_columns, spot_prices, price_components, apply_region, price_blocks, compact_blocks, price_rows, row_matrix
+
+
+CACHE_COLUMNS = ['id', 'vast_variabel_dynamisch', 'contracttype', 'energietype'] + PRICING_COLUMNS
+
+# Snapshot of the priced catalogue, replaced as a whole by rebuild_price_cache:
+# the region-independent price matrix per row; blocks are formatted from it per request
+price_cache = None
+last_import_id = None
+# cache_key the price_rank table was last written for
+ranks_key = None
+# When the price cache was last built, whether or not writing the ranks succeeded
+built_at = None
+_rebuild_lock = threading.Lock()
+
+
+def cache_key(specific_date):
+    # Prices shift with the current hour (next24h) and with the 12:00 publication of tomorrow's prices.
+    # Taken in UTC so the repeated local hour when DST ends gets its own key.
+    return specific_date.astimezone(timezone.utc).strftime('%Y-%m-%dT%H')
+
+
+def rebuild_price_cache(app):
+    global price_cache, built_at
+    with _rebuild_lock, app.app_context(), span('price_cache_rebuild'):
+        context = pricing_context()
+        specific_date = context.specific_date
+
+        rows = [row._asdict() for row in db.session.query(*[getattr(Data, name) for name in CACHE_COLUMNS]).all()]
+        if rows:
+            base, surcharge = price_components(to_columns(rows), spot_prices(context))
+        else:
+            base, surcharge = np.zeros((0, 48)), np.zeros(0)
+        write_price_ranks(rows, base, surcharge, cache_key(specific_date))
+        db.session.remove()
+
+        snapshot = {
+            'key': cache_key(specific_date),
+            'context': context,
+            'index': {row['id']: i for i, row in enumerate(rows)},
+            'base': base,
+            'surcharge': surcharge,
+        }
+        price_cache = snapshot
+        built_at = time.time()
+
+
+def write_price_ranks(rows, base, surcharge, key):
+    # Every worker shares the table: the first to get here with new ranks rewrites it under a row lock,
+    # the others find the same ranks written and skip. Ranks for an earlier hour never replace later ones.
+    global ranks_key
+    today = apply_region(base[:, :24], surcharge)
+    today_avg = today.sum(axis=1) / 24
+    regional = ~np.isnan(surcharge)
+    ids = np.array([row['id'] for row in rows], dtype=np.int64)
+    version = hashlib.sha256(ids.tobytes() + today_avg.tobytes() + regional.tobytes()).hexdigest()
+    try:
+        state = db.session.get(PriceRankState, 1, with_for_update=True)
+        if state is None or (state.version != version and state.hour <= key):
+            db.session.execute(PriceRank.__table__.delete())
+            if rows:
+                db.session.execute(PriceRank.__table__.insert(), [
+                    {'data_id': row_id, 'today_avg': avg, 'regional': flag}
+                    for row_id, avg, flag in zip(ids.tolist(), today_avg.tolist(), regional.tolist())
+                ])
+            if state is None:
+                state = PriceRankState(id=1)
+                db.session.add(state)
+            state.hour = key
+            state.version = version
+        elif state.version == version:
+            # Same ranks as stored, so they are current for this hour as well
+            state.hour = max(state.hour, key)
+        written = key if state.version == version else state.hour
+        db.session.commit()
+        ranks_key = written
+    except Exception as e:
+        db.session.rollback()
+        print(f"Failed to write price ranks: {e}")
+
+
+def ranks_current():
+    return ranks_key == cache_key(pricing_date())
+
+
+def covers(snapshot, context):
+    # The snapshot holds the current window in the default zone, priced on one ENTSO-E series;
+    # a request for anything else, or started against newer prices, is priced directly
+    return (snapshot is not None and snapshot['key'] == cache_key(context.specific_date)
+            and context.zone == DEFAULT_ZONE and snapshot['context'].entsoe_prices is context.entsoe_prices)
+
+
+def get_cached_prices(rows, context, compact=False):
+    snapshot = price_cache
+    if not covers(snapshot, context):
+        increment('price_cache_rows_total', len(rows), result='miss')
+        return price_rows(rows, context, compact=compact)
+    increment('price_cache_rows_total', len(rows), result='hit')
+    matrix = cached_matrix(snapshot, rows, context)
+    return compact_blocks(matrix, context) if compact else price_blocks(matrix, context)
+
+
+def row_components(rows, context):
+    # Region-independent (base, surcharge) per row, taken from the snapshot when it covers them
+    snapshot = price_cache
+    if covers(snapshot, context) and all(row['id'] in snapshot['index'] for row in rows):
+        positions = [snapshot['index'][row['id']] for row in rows]
+        return snapshot['base'][positions], snapshot['surcharge'][positions]
+    if not rows:
+        return np.zeros((0, 48)), np.zeros(0)
+    return price_components(to_columns(rows), spot_prices(context))
+
+
+def cached_matrix(snapshot, rows, context):
+    # Regional prices of the rows; only the region-independent matrix is kept, so memory does not grow
+    # with the (row, region) pairs requested. Rows added after the last rebuild are priced directly.
+    index = snapshot['index']
+    cached = [i for i, row in enumerate(rows) if row['id'] in index]
+    matrix = np.empty((len(rows), snapshot['base'].shape[1]))
+    if cached:
+        positions = [index[rows[i]['id']] for i in cached]
+        matrix[cached] = apply_region(snapshot['base'][positions], snapshot['surcharge'][positions], context.afname_regio)
+    if len(cached) < len(rows):
+        uncached = [i for i, row in enumerate(rows) if row['id'] not in index]
+        matrix[uncached] = row_matrix([rows[i] for i in uncached], context)
+    return matrix
+
+
+def check_import(app):
+    global last_import_id
+    with app.app_context():
+        import_id = db.session.query(db.func.max(ImportLog.id)).scalar()
+        db.session.remove()
+    if import_id != last_import_id:
+        changed = last_import_id is not None
+        last_import_id = import_id
+        if changed:
+            # The new snapshot replaces the old one in one assignment, so requests keep the old prices until then
+            rebuild_price_cache(app)
@@ -0,0 +1,199 @@
+import numpy as np
+from datetime import datetime, timedelta
+from typing import NamedTuple
+
+from . import netkosten
+from .entsoe import HourlyPrices, get_entsoe_prices, epoch_hour, local_day_start, DEFAULT_ZONE, LOCAL_TIMEZONE
+from .netkosten import get_region_cost
+
+
+BIJZ_ACCIJNS = 1.4121
+BIJDRAGE_ENERGIE = 0.1926
+AANSLUITINGSVERGOEDING = 0.075
+BTW_FACTOR = 1.06
+
+PRICING_COLUMNS = ['a', 'd', 'prijs', 'waarde_x_laatst_gekende', 'wkk', 'groene_stroom']
+
+
+def pricing_date(day=None, now=None):
+    # Now in Brussels, or the same local hour on another day to price a past or future window from the history store
+    specific_date = now or datetime.now(LOCAL_TIMEZONE)
+    if day is not None:
+        specific_date = LOCAL_TIMEZONE.localize(datetime(day.year, day.month, day.day, specific_date.hour))
+    return specific_date
+
+
+def window_start(specific_date):
+    # Epoch hour of local midnight on the priced day; the 48-hour window runs from there
+    return epoch_hour(local_day_start(specific_date))
+
+
+def current_slot(specific_date):
+    # Position of the current hour in the window; differs from the clock hour on DST change days
+    return epoch_hour(specific_date) - window_start(specific_date)
+
+
+class PricingContext(NamedTuple):
+    # Everything one request is priced against, fixed when it starts: the window to price,
+    # the wall-clock time deciding what is published, the grid cost of the customer's region
+    # and the ENTSO-E series of the zone. Refreshes swap in new data without affecting it.
+    specific_date: datetime
+    now: datetime
+    region: str
+    afname_regio: float
+    zone: str
+    entsoe_prices: HourlyPrices
+
+
+def pricing_context(postcode=None, day=None, zone=DEFAULT_ZONE, now=None):
+    now = now or datetime.now(LOCAL_TIMEZONE)
+    specific_date = pricing_date(day, now)
+    # Postcode and tariff from one netkosten snapshot
+    zip_regions, tarieven = netkosten.netkosten_index
+    region = zip_regions.get(str(postcode).strip(), "") if postcode else ""
+    afname_regio = get_region_cost(region, tarieven, specific_date.month)
+    return PricingContext(specific_date, now, region, afname_regio, zone, get_entsoe_prices(zone))
+
+
+def to_columns(rows):
+    # None becomes NaN so missing values can be masked out below
+    columns = {name: np.array([row[name] for row in rows], dtype=float) for name in PRICING_COLUMNS}
+    columns['dynamisch'] = np.array([row['vast_variabel_dynamisch'] == 'Dynamisch' for row in rows], dtype=bool)
+    columns['variabel'] = np.array([row['vast_variabel_dynamisch'] == 'Variabel' for row in rows], dtype=bool)
+    columns['afname_elektriciteit'] = np.array(
+        [row['contracttype'] == 'Afname' and row['energietype'] == 'Elektriciteit' for row in rows], dtype=bool)
+    return columns
+
+
+def spot_prices(context, hours=48):
+    return context.entsoe_prices.window(window_start(context.specific_date), hours)
+
+
+def _truthy(values):
+    return ~np.isnan(values) & (values != 0)
+
+
+def price_terms(columns):
+    # Per row: the constant price, whether the hourly a·spot + d formula replaces it where the
+    # spot price is known, whether BTW applies, and the levies (NaN for rows without them)
+    a = columns['a']
+    d = columns['d']
+    prijs = columns['prijs']
+
+    has_prijs = _truthy(prijs)
+    fixed = np.where(has_prijs, prijs, 0.0)
+
+    # Variabel: the listed price, or the a·x + d formula on the last known index value
+    formula_var = _truthy(a) & _truthy(columns['waarde_x_laatst_gekende'])
+    variabel = np.where(has_prijs, prijs, np.where(formula_var, a * columns['waarde_x_laatst_gekende'] + d, 0.0))
+    constant = np.where(columns['variabel'], variabel, fixed)
+
+    # Dynamisch: a·spot + d for every hour the ENTSO-E price is known
+    formula_dyn = columns['dynamisch'] & _truthy(a) & _truthy(d)
+
+    # Afname elektriciteit carries BTW plus the levies; the regional grid cost is added per request.
+    # Rows without wkk or groene stroom only get the BTW (surcharge stays NaN).
+    afname = columns['afname_elektriciteit']
+    surcharge = np.where(afname, columns['groene_stroom'] + columns['wkk'] + BIJZ_ACCIJNS + BIJDRAGE_ENERGIE + AANSLUITINGSVERGOEDING, np.nan)
+    return constant, formula_dyn, afname, surcharge
+
+
+def price_components(columns, spot):
+    constant, formula_dyn, afname, surcharge = price_terms(columns)
+    base = constant[:, None].repeat(len(spot), axis=1)
+    dynamic = columns['a'][:, None] * spot[None, :] + columns['d'][:, None]
+    base = np.where(formula_dyn[:, None] & ~np.isnan(spot)[None, :], dynamic, base)
+    base[afname] *= BTW_FACTOR
+    return base, surcharge
+
+
+def apply_region(base, surcharge, afname_regio=0):
+    add = ~np.isnan(surcharge)
+    return np.round(np.where(add[:, None], base + (surcharge + (afname_regio or 0))[:, None], base), 6)
+
+
+def price_matrix(columns, spot, afname_regio=0):
+    return apply_region(*price_components(columns, spot), afname_regio)
+
+
+def _series(times, values):
+    return [{"time": time, "price": price} for time, price in zip(times, values)]
+
+
+def published(matrix, context):
+    # Day-ahead prices for tomorrow are only published around noon; days after that are zeroed.
+    # Windows in the past are shown as they are.
+    now = context.now
+    last_day = now.date() + timedelta(days=0 if now.hour < 12 else 1)
+    first_day = context.specific_date.date()
+    hidden = [day for day in range(matrix.shape[1] // 24) if first_day + timedelta(days=day) > last_day]
+    if hidden:
+        matrix = matrix.copy()
+        matrix[:, hidden[0] * 24:] = 0
+    return matrix
+
+
+def time_axis(specific_date):
+    first_hour = window_start(specific_date)
+    return [datetime.fromtimestamp((first_hour + i) * 3600, LOCAL_TIMEZONE).strftime('%Y-%m-%dT%H:00:00%z') for i in range(48)]
+
+
+def price_stats(matrix, current_hour):
+    stats = {}
+    windows = (('today', matrix[:, :24]), ('tomorrow', matrix[:, 24:]), ('next24h', matrix[:, current_hour:current_hour + 24]))
+    for name, values in windows:
+        stats[name + '_min'] = values.min(axis=1).tolist()
+        stats[name + '_max'] = values.max(axis=1).tolist()
+        stats[name + '_avg'] = (values.sum(axis=1) / values.shape[1]).tolist()
+    return stats
+
+
+def price_blocks(matrix, context):
+    specific_date = context.specific_date
+    current_hour = current_slot(specific_date)
+    matrix = published(matrix, context)
+    stats = price_stats(matrix, current_hour)
+
+    times = time_axis(specific_date)
+    times_next24h = times[current_hour:current_hour + 24]
+    hourly = matrix.tolist()
+
+    blocks = []
+    for i in range(len(matrix)):
+        block = {
+            "prices_today": _series(times[:24], hourly[i][:24]),
+            "prices_tomorrow": _series(times[24:], hourly[i][24:]),
+            "prices_next24h": _series(times_next24h, hourly[i][current_hour:current_hour + 24]),
+        }
+        for name, values in stats.items():
+            block[name] = values[i]
+        blocks.append(block)
+    return blocks
+
+
+def compact_blocks(matrix, context):
+    # Only the 48 hourly prices on the shared time axis from time_axis(), plus the summary values
+    matrix = published(matrix, context)
+    stats = price_stats(matrix, current_slot(context.specific_date))
+    hourly = matrix.tolist()
+
+    blocks = []
+    for i in range(len(matrix)):
+        block = {"hourly": hourly[i]}
+        for name, values in stats.items():
+            block[name] = values[i]
+        blocks.append(block)
+    return blocks
+
+
+def row_matrix(rows, context):
+    return price_matrix(to_columns(rows), spot_prices(context), context.afname_regio)
+
+
+def price_rows(rows, context, compact=False):
+    if not rows:
+        return []
+    matrix = row_matrix(rows, context)
+    if compact:
+        return compact_blocks(matrix, context)
+    return price_blocks(matrix, context)
@@ -0,0 +1,105 @@
+from . import db
+from .models import Data, PriceRank
+from .utils import MONTHS
+
+
+# Columns with a small, fixed set of values are matched exactly so the indexes can be used
+EXACT_FILTERS = ['jaar', 'segment', 'energietype', 'contracttype', 'vast_variabel_dynamisch']
+SEARCH_FILTERS = ['handelsnaam', 'prijsonderdeel']
+
+# The long description texts are only loaded for the rows that end up in the response
+DESCRIPTION_COLUMNS = ['beschrijving_x', 'beschrijving_y']
+SLIM_COLUMNS = [column.name for column in Data.__table__.columns if column.name not in DESCRIPTION_COLUMNS]
+DESCRIPTION_BATCH = 1000
+
+
+def month_filter(value):
+    # Months are stored abbreviated, in full or as a number ("apr", "April", "mrt", "maart", "4").
+    # Every spelling of the month is matched on its prefix, which the index can still serve.
+    number = MONTHS.get(str(value).strip().lower()[:3])
+    if number is None:
+        return Data.maand == value
+    prefixes = [name for name, month in MONTHS.items() if month == number]
+    return db.or_(Data.maand == str(number), *[Data.maand.like(f'{prefix}%') for prefix in prefixes])
+
+
+def filter_query(query, filters):
+    for key, value in filters.items():
+        if not value:
+            continue
+        if key == 'maand':
+            query = query.filter(month_filter(value))
+        elif key == 'id' or key in EXACT_FILTERS:
+            query = query.filter(getattr(Data, key) == value)
+        elif key in SEARCH_FILTERS:
+            query = query.filter(getattr(Data, key).ilike(f'%{value}%'))
+    return query
+
+
+def ranked_query(query, afname_regio=0, descending=True, limit=None):
+    # Rank on today's average price precomputed by the price cache; the regional grid cost
+    # only applies to the rows flagged as regional. Rows without a rank go last.
+    today_avg = PriceRank.today_avg + db.case((PriceRank.regional, afname_regio or 0), else_=0)
+    query = query.outerjoin(PriceRank, PriceRank.data_id == Data.id)
+    query = query.order_by(PriceRank.today_avg.is_(None), today_avg.desc() if descending else today_avg.asc(), Data.id)
+    if limit is not None:
+        query = query.limit(limit)
+    return query
+
+
+def slim_query(query):
+    # Plain row tuples for the selected columns instead of hydrated Data objects
+    return query.with_entities(*[getattr(Data, name) for name in SLIM_COLUMNS])
+
+
+def slim_rows(query):
+    return [row._asdict() for row in slim_query(query)]
+
+
+def attach_descriptions(rows):
+    ids = [row['id'] for row in rows]
+    descriptions = {}
+    for start in range(0, len(ids), DESCRIPTION_BATCH):
+        query = db.session.query(Data.id, *[getattr(Data, name) for name in DESCRIPTION_COLUMNS])
+        for row_id, *texts in query.filter(Data.id.in_(ids[start:start + DESCRIPTION_BATCH])):
+            descriptions[row_id] = texts
+    for row in rows:
+        row.update(zip(DESCRIPTION_COLUMNS, descriptions.get(row['id'], [None] * len(DESCRIPTION_COLUMNS))))
+    return rows
+
+
+# Older imports stored the year as "2024.0". These convert such rows to "2024" so the exact jaar filter and
+# the unique key match them; where a row in the new format already exists, it is the newer one and the old row goes.
+_LEGACY_JAAR = "SUBSTR(legacy.jaar, 1, LENGTH(legacy.jaar) - 2)"
+NORMALIZE_JAAR = [
+    f"""
+    DELETE FROM data WHERE id IN (
+        SELECT id FROM (
+            SELECT legacy.id FROM data legacy JOIN data normalized
+            ON normalized.jaar = {_LEGACY_JAAR} AND normalized.maand = legacy.maand AND normalized.handelsnaam = legacy.handelsnaam
+            AND normalized.productnaam = legacy.productnaam AND normalized.prijsonderdeel = legacy.prijsonderdeel
+            WHERE legacy.jaar LIKE '%.0'
+        ) AS duplicates
+    )""",
+    "UPDATE data SET jaar = SUBSTR(jaar, 1, LENGTH(jaar) - 2) WHERE jaar LIKE '%.0'",
+]
+
+
+def normalize_jaar():
+    try:
+        for statement in NORMALIZE_JAAR:
+            db.session.execute(db.text(statement))
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        print(f"Failed to normalize jaar: {e}")
+
+
+def ensure_indexes():
+    # create_all() leaves existing tables alone, so add indexes introduced after the table was created
+    for table in (Data.__table__, PriceRank.__table__):
+        for index in table.indexes:
+            try:
+                index.create(bind=db.engine, checkfirst=True)
+            except Exception as e:
+                print(f"Failed to create index {index.name}: {e}")
@@ -0,0 +1,63 @@
+import os
+import numpy as np
+
+from .models import Data
+from . import netkosten
+from .netkosten import get_region_cost
+from .price_cache import CACHE_COLUMNS, row_components
+from .pricing import published
+
+
+MAX_QUOTE_POSTCODES = int(os.getenv('MAX_QUOTE_POSTCODES', 10000))
+MAX_QUOTE_PROFILES = 20
+QUOTE_COLUMNS = ['handelsnaam', 'productnaam', 'prijsonderdeel']
+
+
+def quote_rows(query):
+    return [row._asdict() for row in query.with_entities(*[getattr(Data, name) for name in CACHE_COLUMNS + QUOTE_COLUMNS])]
+
+
+def region_values(rows, offsets, context, profiles=None):
+    # values[region, profile, row]: today's average price per region, or with profiles the cost of
+    # each 24-hour consumption profile (kWh per hour). Products are priced once; the regional grid
+    # cost is a broadcast add on the rows that carry it, as in apply_region.
+    base, surcharge = row_components(rows, context)
+    today = published(base[:, :24], context)
+    visible = float(published(np.ones((1, 24)), context)[0, 0])
+    regional = ~np.isnan(surcharge)
+    levies = np.where(regional, surcharge, 0.0)[None, :] + offsets[:, None] * regional[None, :]
+    if profiles is None:
+        return (today.mean(axis=1)[None, :] + levies * visible)[:, None, :]
+    energy = profiles.sum(axis=1)
+    return (today @ profiles.T).T[None, :, :] + levies[:, None, :] * energy[None, :, None] * visible
+
+
+def rank(rows, values, limit, descending, field):
+    order = np.argsort(-values if descending else values, kind='stable')[:limit]
+    return [{**{name: rows[i][name] for name in ['id'] + QUOTE_COLUMNS}, field: round(float(values[i]), 6)}
+            for i in order]
+
+
+def quote_postcodes(rows, postcodes, context, limit=10, descending=False, profiles=None):
+    # `context` has no region of its own; each postcode's grid cost comes from one netkosten snapshot
+    zip_regions, tarieven = netkosten.netkosten_index
+    regions = [zip_regions.get(str(postcode).strip(), "") for postcode in postcodes]
+    unique = sorted(set(regions))
+    month = context.specific_date.month
+    offsets = np.array([get_region_cost(region, tarieven, month) or 0 for region in unique], dtype=float)
+
+    names = list(profiles) if profiles else None
+    weights = np.array([profiles[name] for name in names], dtype=float) if profiles else None
+    values = region_values(rows, offsets, context, weights)
+
+    # Postcodes in the same region share one ranking
+    rankings = {}
+    for r, region in enumerate(unique):
+        if names is None:
+            rankings[region] = {'ranking': rank(rows, values[r, 0], limit, descending, 'today_avg')}
+        else:
+            rankings[region] = {'rankings': {name: rank(rows, values[r, p], limit, descending, 'cost')
+                                             for p, name in enumerate(names)}}
+    costs = dict(zip(unique, offsets.tolist()))
+    return [{'postcode': postcode, 'region': region, 'afname_regio': costs[region], **rankings[region]}
+            for postcode, region in zip(postcodes, regions)]
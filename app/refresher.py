@@ -0,0 +1,150 @@
+from datetime import datetime, timedelta
+import os
+import random
+import sys
+import threading
+import time
+
+from . import entsoe, netkosten
+from .entsoe import update_entsoe_data, load_entsoe_snapshot, epoch_hour, series_name, zone_timezone, ENTSOE_ZONES, LOCAL_TIMEZONE
+from .netkosten import fetch_region_prices, load_netkosten_snapshot
+from .snapshots import snapshot_changed, snapshot_path
+
+
+# The day-ahead auction results are published around 12:45 CET; fetch shortly after
+PUBLICATION_HOUR = 13
+PUBLICATION_MINUTE = 5
+# Failed runs are retried after RETRY_BASE, 2·RETRY_BASE, ... seconds (capped), until the next regular run
+REFRESH_RETRIES = int(os.getenv('REFRESH_RETRIES', 6))
+RETRY_BASE = int(os.getenv('REFRESH_RETRY_BASE', 60))
+RETRY_MAX = 3600
+
+# name -> runs, failures, consecutive_failures, last_run, last_success, last_duration
+job_stats = {}
+
+
+def next_refresh(updated_at, interval):
+    # Refresh right away unless the snapshot we started from is still fresh
+    if updated_at is None:
+        return datetime.now()
+    return max(datetime.now(), datetime.fromtimestamp(updated_at) + interval)
+
+
+def day_ahead_end(timezone=LOCAL_TIMEZONE):
+    # Last hour the day-ahead prices should cover by now: tomorrow once published, otherwise today.
+    # The coupled auction publishes every zone at once, so publication time is taken in Brussels.
+    now = datetime.now(LOCAL_TIMEZONE)
+    days = 2 if (now.hour, now.minute) >= (PUBLICATION_HOUR, PUBLICATION_MINUTE) else 1
+    end = timezone.localize(datetime(now.year, now.month, now.day) + timedelta(days=days))
+    return epoch_hour(end) - 1
+
+
+def entsoe_complete():
+    return all(entsoe.get_entsoe_prices(zone).get(day_ahead_end(zone_timezone(zone))) is not None
+               for zone in ENTSOE_ZONES)
+
+
+def retry_delay(attempt):
+    # Exponential backoff with jitter so several processes don't retry in lockstep
+    return min(RETRY_MAX, RETRY_BASE * 2 ** attempt) * random.uniform(0.5, 1.0)
+
+
+def record_run(name, started_at, duration, ok):
+    stats = job_stats.setdefault(name, {'runs': 0, 'failures': 0, 'consecutive_failures': 0,
+                                        'last_run': None, 'last_success': None, 'last_duration': None})
+    stats['runs'] += 1
+    stats['last_run'] = started_at
+    stats['last_duration'] = duration
+    if ok:
+        stats['consecutive_failures'] = 0
+        stats['last_success'] = started_at
+    else:
+        stats['failures'] += 1
+        stats['consecutive_failures'] += 1
+
+
+def refresh_status():
+    # Job metrics plus the age of the data each job publishes
+    now = time.time()
+    updated = {'entsoe': entsoe.entsoe_updated_at, 'netkosten': netkosten.netkosten_updated_at}
+    return {name: dict(job_stats.get(name, {}), age=now - updated_at if updated_at else None)
+            for name, updated_at in updated.items()}
+
+
+def add_refresh_jobs(scheduler, on_refresh=None):
+    def refresh(name, job, complete=None):
+        lock = threading.Lock()
+        attempts = [0]
+
+        def run(retry=False):
+            # Regular runs and retries are separate scheduler jobs, so overlap is prevented here
+            if not lock.acquire(blocking=False):
+                return
+            if not retry:
+                attempts[0] = 0
+            try:
+                started_at = time.time()
+                try:
+                    ok = job() and (complete is None or complete())
+                except Exception as e:
+                    print(f"Refresh job {name} failed: {e}")
+                    ok = None
+                record_run(name, started_at, time.time() - started_at, ok)
+                # Partial results were still published, so the cache is rebuilt unless the job raised
+                if ok is not None and on_refresh:
+                    on_refresh()
+            finally:
+                lock.release()
+
+            if not ok and attempts[0] < REFRESH_RETRIES:
+                delay = retry_delay(attempts[0])
+                attempts[0] += 1
+                scheduler.add_job(run, 'date', run_date=datetime.now() + timedelta(seconds=delay),
+                                  kwargs={'retry': True}, id=f'{name}-retry', replace_existing=True)
+        return run
+
+    job_options = {'max_instances': 1, 'coalesce': True, 'misfire_grace_time': 600}
+
+    entsoe_job = {'next_run_time': datetime.now()} if not entsoe_complete() else {}
+    entsoe_refresh = refresh('entsoe', update_entsoe_data, entsoe_complete)
+    scheduler.add_job(entsoe_refresh, 'cron', id='entsoe',
+                      hour=PUBLICATION_HOUR, minute=PUBLICATION_MINUTE, timezone=LOCAL_TIMEZONE, jitter=120,
+                      **entsoe_job, **job_options)
+
+    def entsoe_catch_up():
+        # A late publication can outlast the retries; keep trying hourly until the prices are in.
+        # Run as a retry so it doesn't start a new series of them.
+        if not entsoe_complete():
+            entsoe_refresh(retry=True)
+
+    scheduler.add_job(entsoe_catch_up, 'interval', id='entsoe-catch-up', hours=1, jitter=120, **job_options)
+    scheduler.add_job(refresh('netkosten', fetch_region_prices), 'interval', id='netkosten', days=1, jitter=600,
+                      next_run_time=next_refresh(netkosten.netkosten_updated_at, timedelta(days=1)), **job_options)
+
+
+def reload_snapshots():
+    changed = False
+    zones = [zone for zone in ENTSOE_ZONES if snapshot_changed(snapshot_path(series_name(zone), 'npy'))]
+    if zones:
+        changed = load_entsoe_snapshot(zones) or changed
+    if snapshot_changed(snapshot_path('netkosten', 'json')):
+        changed = load_netkosten_snapshot() or changed
+    return changed
+
+
+def main():
+    # Single writer for the shared snapshots; app workers started with REFRESH_MODE=shared only read them
+    load_entsoe_snapshot()
+    load_netkosten_snapshot()
+    if '--backfill' in sys.argv[1:]:
+        # python -m app.refresher --backfill DAYS: fill the history store once and exit
+        update_entsoe_data(int(sys.argv[sys.argv.index('--backfill') + 1]))
+        return
+    from apscheduler.schedulers.blocking import BlockingScheduler
+    scheduler = BlockingScheduler()
+    add_refresh_jobs(scheduler)
+    scheduler.start()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+import os
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from functools import wraps
+from flask import Response, request
+
+from . import entsoe, netkosten, price_cache
+from .pricing import pricing_date
+
+
+RESPONSE_CACHE_TTL = int(os.getenv('RESPONSE_CACHE_TTL', 300))
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv('RESPONSE_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+# Marks a response served from an older data version under overload; never cached or tagged as current
+STALE_WARNING = '110 - "Response is Stale"'
+
+
+def data_version():
+    # Changes whenever a refresh job publishes new data, an import lands, or the priced hour rolls over.
+    # Built from the data itself rather than a per-process counter so every worker agrees on it.
+    return (entsoe.entsoe_updated_at, netkosten.netkosten_updated_at, price_cache.last_import_id,
+            price_cache.cache_key(pricing_date()))
+
+
+class ResponseCache:
+    # LRU of rendered responses with a TTL and a cap on the total body size
+
+    def __init__(self, ttl, max_bytes):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        # request key without the data version -> newest full key, for serving stale responses under overload
+        self.latest = {}
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                # Expired entries stay until evicted so get_stale() can still fall back on them
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1], entry[2]
+
+    def put(self, key, body, mimetype):
+        if len(body) > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (time.monotonic() + self.ttl, body, mimetype)
+            self.latest[key[:-1]] = key
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+
+    def get_stale(self, key):
+        with self.lock:
+            entry = self.entries.get(self.latest.get(key[:-1]))
+            return (entry[1], entry[2]) if entry else None
+
+    def _remove(self, key):
+        _, body, _ = self.entries.pop(key)
+        if self.latest.get(key[:-1]) == key:
+            del self.latest[key[:-1]]
+        self.size -= len(body)
+
+
+response_cache = ResponseCache(RESPONSE_CACHE_TTL, RESPONSE_CACHE_MAX_BYTES)
+
+
+def request_key():
+    args = sorted((key, value) for key, values in request.args.lists() for value in values if value)
+    return (request.path, tuple(args), request.accept_mimetypes.best, data_version())
+
+
+def cached_response(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        key = request_key()
+        etag = hashlib.sha1(repr(key).encode()).hexdigest()
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+            response.set_etag(etag)
+            return response
+
+        cached = response_cache.get(key)
+        if cached is not None:
+            response = Response(cached[0], mimetype=cached[1])
+        else:
+            response = view(*args, **kwargs)
+            if response.status_code != 200 or response.is_streamed or response.headers.get('Warning') == STALE_WARNING:
+                return response
+            response_cache.put(key, response.get_data(), response.mimetype)
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'no-cache'
+        response.vary.add('Accept')
+        return response
+    return wrapper
@@ -1,13 +1,26 @@
-from flask import request, jsonify, send_from_directory, abort
+from flask import Response, request, jsonify, send_from_directory, abort
 from functools import wraps
 from .utils import transform_data
 from . import db
 from .models import Data
-from .entsoe import get_entsoe_data
-from .netkosten import get_cost_from_zip
+from .queries import filter_query, ranked_query, slim_rows, attach_descriptions
+from .price_cache import ranks_current
+from .streaming import wants_ndjson, stream_query, stream_groups
+from .response_cache import cached_response, response_cache
+from .refresher import refresh_status
+from . import price_cache, entsoe, netkosten
+from .admission import admission_control
+from .metrics import span, increment, render_metrics
+from .quotes import quote_rows, quote_postcodes, MAX_QUOTE_POSTCODES, MAX_QUOTE_PROFILES
+from .simulation import parse_profile, profile_hours, missing_hours, simulate, MAX_SIMULATION_PROFILES, MAX_MISSING_HOURS
+from .pricing import pricing_date, pricing_context, time_axis, current_slot
+from .entsoe import get_entsoe_prices, get_entsoe_range, local_day_start, epoch_hour, zone_timezone, DEFAULT_ZONE, ENTSOE_ZONES
+from datetime import datetime, timedelta
+import numpy as np
 import os
 
 SECURITY_TOKEN = os.getenv('SECURE_TOKEN')
+MAX_PRICE_RANGE_DAYS = 366
 
 def token_required(f):
     @wraps(f)
@@ -18,6 +31,51 @@ def token_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
+def parse_day(value):
+    if not value:
+        return None
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').date()
+    except ValueError:
+        abort(400)
+
+def parse_zone(value):
+    # Bidding zone whose day-ahead prices are used; products carry no zone of their own
+    zone = (value or DEFAULT_ZONE).upper()
+    if zone != DEFAULT_ZONE and zone not in ENTSOE_ZONES:
+        abort(400)
+    return zone
+
+def valid_profile(values):
+    return isinstance(values, list) and len(values) == 24 and all(isinstance(value, (int, float)) for value in values)
+
+def metric_gauges():
+    # Values read at scrape time: data freshness, refresh jobs and cache state
+    gauges = []
+    for source, status in refresh_status().items():
+        gauges.append(('data_age_seconds', {'source': source}, status.get('age')))
+        gauges.append(('refresh_last_duration_seconds', {'job': source}, status.get('last_duration')))
+        gauges.append(('refresh_runs', {'job': source}, status.get('runs')))
+        gauges.append(('refresh_failures', {'job': source}, status.get('failures')))
+    for zone in ENTSOE_ZONES:
+        gauges.append(('entsoe_known_hours', {'zone': zone}, len(get_entsoe_prices(zone))))
+    gauges.append(('response_cache_hits', {}, response_cache.hits))
+    gauges.append(('response_cache_misses', {}, response_cache.misses))
+    gauges.append(('response_cache_entries', {}, len(response_cache.entries)))
+    gauges.append(('response_cache_bytes', {}, response_cache.size))
+    snapshot = price_cache.price_cache
+    gauges.append(('price_cache_rows', {}, len(snapshot['index']) if snapshot else 0))
+    return gauges
+
+def readiness():
+    # A worker is ready once it has prices, grid costs and a built price cache to serve from.
+    # built_at rather than the cache itself, which is briefly None while a refresh rebuilds it.
+    return {
+        'entsoe': entsoe.entsoe_updated_at is not None,
+        'netkosten': netkosten.netkosten_updated_at is not None,
+        'price_cache': price_cache.built_at is not None,
+    }
+
 def init_routes(app):
     @app.route('/')
     # @token_required
@@ -26,6 +84,8 @@ def init_routes(app):
 
     @app.route('/data', methods=['GET'])
     # @token_required
+    @cached_response
+    @admission_control
     def get_data():
         filters = {
             'jaar': request.args.get('jaar'),
@@ -43,20 +103,29 @@ def init_routes(app):
         top = request.args.get('top', type=int)
         bottom = request.args.get('bottom', type=int)
         postcode = request.args.get('postcode')
+        compact = request.args.get('format') == 'compact'
+        day = parse_day(request.args.get('date'))
+        zone = parse_zone(request.args.get('zone'))
+        context = pricing_context(postcode, day, zone)
 
-        afname_regio = get_cost_from_zip(postcode)
+        query = filter_query(Data.query, filters)
+        stream = wants_ndjson()
+        if stream and top is None and bottom is None:
+            return stream_query(query, context, show_prices=show_prices)
 
-        query = Data.query
-        for key, value in filters.items():
-            if value:
-                if key == 'id':
-                    query = query.filter(getattr(Data, key) == value)
-                else:
-                    query = query.filter(getattr(Data, key).ilike(f'%{value}%'))
+        # top/bottom rank on price, so like the exact sort below they only apply with show_prices
+        if show_prices and (top is not None or bottom is not None) and day is None and zone == DEFAULT_ZONE and ranks_current():
+            # Only the top/bottom rows are loaded and priced; the exact sort below runs on those
+            if top is not None:
+                query = ranked_query(query, context.afname_regio, descending=True, limit=top)
+            else:
+                query = ranked_query(query, context.afname_regio, descending=False, limit=bottom)
 
-        result = query.all()
-        result_dict = [row.to_dict() for row in result]
-        transformed_data = transform_data(result_dict, show_prices=show_prices, afname_regio_val=afname_regio)
+        with span('query'):
+            result_dict = slim_rows(query)
+        increment('data_rows_total', len(result_dict))
+        with span('transform'):
+            transformed_data = transform_data(result_dict, show_prices=show_prices, context=context, compact=compact)
 
         all_entries = []
         for key, value in transformed_data.items():
@@ -64,13 +133,17 @@ def init_routes(app):
                 entry['type'] = key
                 all_entries.append(entry)
 
-        if top is not None:
-            all_entries.sort(key=lambda x: x['prices']['today_avg'], reverse=True)
-            all_entries = all_entries[:top]
+        with span('sort'):
+            if top is not None and show_prices:
+                all_entries.sort(key=lambda x: x['prices']['today_avg'], reverse=True)
+                all_entries = all_entries[:top]
 
-        if bottom is not None:
-            all_entries.sort(key=lambda x: x['prices']['today_avg'])
-            all_entries = all_entries[:bottom]
+            if bottom is not None and show_prices:
+                all_entries.sort(key=lambda x: x['prices']['today_avg'])
+                all_entries = all_entries[:bottom]
+
+        with span('descriptions'):
+            attach_descriptions(all_entries)
 
         filtered_data = {}
         for entry in all_entries:
@@ -82,4 +155,108 @@ def init_routes(app):
                 }
             filtered_data[type_key]['prijsonderdelen'].append(entry)
 
-        return jsonify(filtered_data)
+        if stream:
+            return stream_groups(filtered_data)
+        with span('serialize'):
+            if compact:
+                # Every row's "hourly" prices share this axis: today 00:00 to tomorrow 23:00, next24h starts at next24h_start
+                return jsonify({
+                    'times': time_axis(context.specific_date),
+                    'next24h_start': current_slot(context.specific_date),
+                    'data': filtered_data
+                })
+            return jsonify(filtered_data)
+
+    @app.route('/prices', methods=['GET'])
+    # @token_required
+    @cached_response
+    def get_prices():
+        # Hourly day-ahead prices from the local history store, for whole days from start up to and including end
+        start = parse_day(request.args.get('start')) or pricing_date().date()
+        end = parse_day(request.args.get('end')) or start
+        if end < start or (end - start).days > MAX_PRICE_RANGE_DAYS:
+            abort(400)
+        zone = parse_zone(request.args.get('zone'))
+        timezone = zone_timezone(zone)
+
+        first_hour, prices = get_entsoe_range(local_day_start(start, 0, timezone), local_day_start(end, 1, timezone), zone)
+        times = [datetime.fromtimestamp((first_hour + i) * 3600, timezone).strftime('%Y-%m-%dT%H:00:00%z')
+                 for i in range(len(prices))]
+        return jsonify([{"time": time, "price": None if np.isnan(price) else price}
+                        for time, price in zip(times, prices.tolist())])
+
+    @app.route('/quotes', methods=['POST'])
+    # @token_required
+    @admission_control
+    def post_quotes():
+        # Rank the products for many postcodes at once:
+        # {"postcodes": [...], "filters": {...}, "limit": 10, "order": "asc", "profiles": {"name": [24 x kWh]}, "date", "zone"}
+        body = request.get_json(silent=True)
+        if not isinstance(body, dict):
+            abort(400)
+        postcodes = body.get('postcodes')
+        filters = body.get('filters') or {}
+        profiles = body.get('profiles')
+        limit = body.get('limit', 10)
+        if not isinstance(postcodes, list) or not 0 < len(postcodes) <= MAX_QUOTE_POSTCODES \
+                or not isinstance(filters, dict) or not isinstance(limit, int) or limit < 1:
+            abort(400)
+        if profiles is not None and (not isinstance(profiles, dict) or not 0 < len(profiles) <= MAX_QUOTE_PROFILES
+                                     or any(not valid_profile(values) for values in profiles.values())):
+            abort(400)
+
+        day = parse_day(body.get('date'))
+        zone = parse_zone(body.get('zone'))
+        rows = quote_rows(filter_query(Data.query, filters))
+        context = pricing_context(day=day, zone=zone)
+        quotes = quote_postcodes(rows, postcodes, context, limit=limit, descending=body.get('order') == 'desc', profiles=profiles)
+        return jsonify({'date': context.specific_date.date().isoformat(), 'zone': zone, 'quotes': quotes})
+
+    @app.route('/simulate', methods=['POST'])
+    # @token_required
+    @admission_control
+    def post_simulate():
+        # Rank the products by their cost over a year of consumption, priced on the stored hourly history:
+        # {"profiles": {"name": [8760 hourly or 35040 quarter-hourly kWh] or {"slp": "residential", "annual_kwh": 3500}},
+        #  "postcode", "filters": {...}, "start": "YYYY-MM-DD", "limit": 10, "order": "asc", "zone"}
+        body = request.get_json(silent=True)
+        if not isinstance(body, dict):
+            abort(400)
+        profiles = body.get('profiles')
+        filters = body.get('filters') or {}
+        limit = body.get('limit', 10)
+        if not isinstance(profiles, dict) or not 0 < len(profiles) <= MAX_SIMULATION_PROFILES \
+                or not isinstance(filters, dict) or not isinstance(limit, int) or limit < 1:
+            abort(400)
+        try:
+            profiles = {name: parse_profile(values) for name, values in profiles.items()}
+            hours = profile_hours(profiles.values())
+        except ValueError:
+            abort(400)
+
+        zone = parse_zone(body.get('zone'))
+        timezone = zone_timezone(zone)
+        # By default the window ends at the start of today
+        start = parse_day(body.get('start')) or pricing_date().date() - timedelta(days=hours // 24)
+        first_hour = epoch_hour(local_day_start(start, 0, timezone))
+        context = pricing_context(body.get('postcode'), zone=zone)
+        # Unknown hours would fall back to the constant price, which is 0 for most dynamic contracts
+        missing = missing_hours(context, first_hour, hours)
+        if missing > MAX_MISSING_HOURS:
+            response = jsonify({'error': 'The stored price history does not cover this window',
+                                'start': start.isoformat(), 'hours': hours, 'missing_hours': missing})
+            response.status_code = 422
+            return response
+        rows = quote_rows(filter_query(Data.query, filters))
+        with span('simulate'):
+            simulation = simulate(rows, profiles, context, first_hour, limit=limit, descending=body.get('order') == 'desc')
+        return jsonify({'start': start.isoformat(), 'zone': zone, 'region': context.region, **simulation})
+
+    @app.route('/metrics', methods=['GET'])
+    def get_metrics():
+        return Response(render_metrics(metric_gauges()), mimetype='text/plain; version=0.0.4')
+
+    @app.route('/ready', methods=['GET'])
+    def get_ready():
+        checks = readiness()
+        return jsonify(checks), 200 if all(checks.values()) else 503
@@ -0,0 +1,198 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime
+from functools import lru_cache
+from itertools import repeat
+import numpy as np
+
+from . import netkosten
+from .netkosten import get_region_cost
+from .entsoe import zone_timezone
+from .pricing import BTW_FACTOR, to_columns, price_terms
+from .quotes import rank
+
+
+# A year of hourly consumption in kWh: 8760 (8784) hourly or 35040 (35136) quarter-hourly values
+PROFILE_HOURS = (8760, 8784)
+QUARTER_HOURS = tuple(hours * 4 for hours in PROFILE_HOURS)
+MAX_SIMULATION_PROFILES = int(os.getenv('MAX_SIMULATION_PROFILES', 1000))
+# Hours of history folded into the profile totals per step, and profiles costed per step,
+# so memory stays flat however long the window or large the batch
+CHUNK_HOURS = 31 * 24
+PROFILE_BATCH = 256
+# Batches of more than PROFILE_BATCH profiles are totalled on one pool of this many processes per worker
+SIMULATION_WORKERS = int(os.getenv('SIMULATION_WORKERS', os.cpu_count() or 1))
+# Hours in the window the stored history may lack before a simulation is refused
+MAX_MISSING_HOURS = int(os.getenv('SIMULATION_MAX_MISSING_HOURS', 24))
+
+_pool = None
+_pool_lock = threading.Lock()
+
+# Synthetic load profiles: relative consumption per local hour on weekdays and weekends, and the
+# seasonal swing (highest in January). Approximations of the residential and business shapes,
+# scaled to the requested annual consumption.
+SLP_SHAPES = {
+    'residential': {
+        'weekday': [0.5, 0.4, 0.35, 0.35, 0.35, 0.4, 0.7, 1.0, 0.9, 0.7, 0.65, 0.7,
+                    0.75, 0.7, 0.65, 0.7, 0.85, 1.1, 1.4, 1.5, 1.4, 1.2, 0.95, 0.7],
+        'weekend': [0.55, 0.45, 0.4, 0.35, 0.35, 0.35, 0.45, 0.65, 0.9, 1.0, 1.05, 1.1,
+                    1.1, 1.0, 0.9, 0.9, 1.0, 1.2, 1.45, 1.5, 1.4, 1.2, 0.95, 0.7],
+        'seasonal': 0.25,
+    },
+    'business': {
+        'weekday': [0.3, 0.3, 0.3, 0.3, 0.3, 0.35, 0.6, 1.1, 1.5, 1.6, 1.6, 1.55,
+                    1.45, 1.55, 1.6, 1.55, 1.4, 1.0, 0.6, 0.45, 0.4, 0.35, 0.3, 0.3],
+        'weekend': [0.3] * 24,
+        'seasonal': 0.1,
+    },
+}
+
+
+def parse_profile(value):
+    # An uploaded list of kWh values as an hourly array, or ('slp', name, annual kWh) built per window.
+    # Raises ValueError when the profile is not usable.
+    if isinstance(value, dict):
+        name = value.get('slp')
+        annual_kwh = value.get('annual_kwh')
+        if name not in SLP_SHAPES or not isinstance(annual_kwh, (int, float)) or annual_kwh <= 0:
+            raise ValueError('unknown load profile')
+        return ('slp', name, float(annual_kwh))
+    if not isinstance(value, list) or len(value) not in PROFILE_HOURS + QUARTER_HOURS:
+        raise ValueError('a profile needs 8760 hourly or 35040 quarter-hourly values')
+    try:
+        values = np.array(value, dtype=float)
+    except (TypeError, ValueError):
+        raise ValueError('profile values must be numbers')
+    if not np.isfinite(values).all():
+        raise ValueError('profile values must be numbers')
+    if len(values) in QUARTER_HOURS:
+        values = values.reshape(-1, 4).sum(axis=1)
+    return values
+
+
+def profile_hours(profiles):
+    # Window length the uploaded profiles agree on; synthetic profiles fit any window
+    lengths = {len(profile) for profile in profiles if not isinstance(profile, tuple)}
+    if len(lengths) > 1:
+        raise ValueError('profiles cover different numbers of hours')
+    return lengths.pop() if lengths else PROFILE_HOURS[0]
+
+
+def missing_hours(context, first_hour, hours):
+    return int(np.isnan(context.entsoe_prices.window(first_hour, hours)).sum())
+
+
+@lru_cache(maxsize=8)
+def calendar(first_hour, hours, zone):
+    # Local hour of day, weekend flag and month of every hour in the window
+    timezone = zone_timezone(zone)
+    local = [datetime.fromtimestamp((first_hour + i) * 3600, timezone) for i in range(hours)]
+    return (np.array([moment.hour for moment in local]),
+            np.array([moment.weekday() >= 5 for moment in local]),
+            np.array([moment.month for moment in local]))
+
+
+def slp_load(name, annual_kwh, window):
+    hour, weekend, month = window
+    shape = SLP_SHAPES[name]
+    weights = np.where(weekend, np.array(shape['weekend'])[hour], np.array(shape['weekday'])[hour])
+    weights = weights * (1 + shape['seasonal'] * np.cos(2 * np.pi * (month - 1) / 12))
+    return weights / weights.sum() * annual_kwh
+
+
+def profile_totals(profiles, spot, window):
+    # totals[profile]: spot-weighted kWh, kWh in hours with a known spot price, then kWh per month 1..12.
+    # Every product's cost is linear in these, so the history is only walked once per profile.
+    loads = np.array([slp_load(*profile[1:], window) if isinstance(profile, tuple) else profile
+                      for profile in profiles])
+    month = window[2]
+    known = ~np.isnan(spot)
+    totals = np.zeros((len(profiles), 14))
+    for start in range(0, len(spot), CHUNK_HOURS):
+        end = min(start + CHUNK_HOURS, len(spot))
+        terms = np.zeros((end - start, 14))
+        terms[:, 0] = np.where(known[start:end], spot[start:end], 0.0)
+        terms[:, 1] = known[start:end]
+        terms[np.arange(end - start), month[start:end] + 1] = 1
+        totals += loads[:, start:end] @ terms
+    return totals
+
+
+def profile_pool():
+    # Started on first use and shared by all requests, so concurrent simulations queue on the same
+    # processes. Forkserver (or spawn) workers start clean rather than forking the threaded server.
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+            _pool = ProcessPoolExecutor(max_workers=SIMULATION_WORKERS, mp_context=multiprocessing.get_context(method))
+        return _pool
+
+
+def discard_pool(pool):
+    # A worker died (e.g. killed for memory) and the pool refuses further work; the next batch starts a new one
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False)
+
+
+def all_profile_totals(profiles, spot, window):
+    batches = [profiles[i:i + PROFILE_BATCH] for i in range(0, len(profiles), PROFILE_BATCH)]
+    if len(batches) > 1 and SIMULATION_WORKERS >= 2:
+        pool = profile_pool()
+        try:
+            return np.concatenate(list(pool.map(profile_totals, batches, repeat(spot), repeat(window))))
+        except BrokenProcessPool as e:
+            print(f"Simulation pool broke, totalling in-process: {e}")
+            discard_pool(pool)
+    return np.concatenate([profile_totals(batch, spot, window) for batch in batches])
+
+
+def annual_costs(terms, totals, grid_costs):
+    # cost[row, profile]: Σ hourly price · kWh, with the same price rules as price_components and apply_region
+    a, d, constant, formula_dyn, afname, surcharge = terms
+    spot_kwh, known_kwh, monthly = totals[:, 0], totals[:, 1], totals[:, 2:]
+    energy = monthly.sum(axis=1)
+    dynamic = a[:, None] * spot_kwh[None, :] + d[:, None] * known_kwh[None, :] + constant[:, None] * (energy - known_kwh)[None, :]
+    costs = np.where(formula_dyn[:, None], dynamic, constant[:, None] * energy[None, :])
+    costs[afname] *= BTW_FACTOR
+    # Levies on every kWh, the regional grid cost at each month's tariff
+    regional = ~np.isnan(surcharge)
+    levies = np.where(regional, surcharge, 0.0)[:, None] * energy[None, :] + regional[:, None] * (monthly @ grid_costs)[None, :]
+    return costs + levies
+
+
+def simulate(rows, profiles, context, first_hour, limit=10, descending=False):
+    # Rank the products by their cost over the window starting at `first_hour` for every
+    # profile (name -> parsed profile), priced on the stored history of the context's zone
+    names = list(profiles)
+    parsed = [profiles[name] for name in names]
+    hours = profile_hours(parsed)
+    window = calendar(first_hour, hours, context.zone)
+    spot = context.entsoe_prices.window(first_hour, hours)
+    totals = all_profile_totals(parsed, spot, window)
+
+    _, tarieven = netkosten.netkosten_index
+    grid_costs = np.array([get_region_cost(context.region, tarieven, month) or 0 for month in range(1, 13)], dtype=float)
+    columns = to_columns(rows)
+    constant, formula_dyn, afname, surcharge = price_terms(columns)
+    terms = (np.where(formula_dyn, columns['a'], 0.0), np.where(formula_dyn, columns['d'], 0.0),
+             constant, formula_dyn, afname, surcharge)
+
+    results = {}
+    for start in range(0, len(names), PROFILE_BATCH):
+        batch = totals[start:start + PROFILE_BATCH]
+        costs = annual_costs(terms, batch, grid_costs)
+        for p, name in enumerate(names[start:start + PROFILE_BATCH]):
+            energy = float(batch[p, 2:].sum())
+            results[name] = {
+                'energy_kwh': round(energy, 3),
+                'priced_kwh': round(float(batch[p, 1]), 3),
+                'ranking': rank(rows, costs[:, p], limit, descending, 'cost'),
+            }
+    return {'hours': hours, 'known_hours': int((~np.isnan(spot)).sum()), 'results': results}
@@ -0,0 +1,86 @@
+import os
+import json
+import time
+import numpy as np
+
+
+SNAPSHOT_DIR = os.getenv('SNAPSHOT_DIR', 'snapshots')
+# Bump when the layout of a snapshot changes; older files are then ignored
+SNAPSHOT_FORMAT = 2
+
+# path -> mtime of the file the current in-memory data was loaded from
+loaded_mtimes = {}
+
+
+def snapshot_path(name, extension):
+    return os.path.join(SNAPSHOT_DIR, f"{name}.{extension}")
+
+
+def _replace(path, write):
+    # Write next to the target and rename, so readers never see a partial file
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(tmp_path, 'wb') as f:
+            write(f)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f"Failed to write snapshot {path}: {e}")
+
+
+def snapshot_changed(path):
+    try:
+        return os.stat(path).st_mtime != loaded_mtimes.get(path)
+    except FileNotFoundError:
+        return False
+
+
+def _record_mtime(path):
+    try:
+        loaded_mtimes[path] = os.stat(path).st_mtime
+    except FileNotFoundError:
+        pass
+
+
+def save_series(name, first_hour, values, fetched_at=None):
+    # One float64 file: [format, fetched_at, first_hour, values...] so it can be memory-mapped as is
+    header = np.array([SNAPSHOT_FORMAT, fetched_at or time.time(), first_hour], dtype=np.float64)
+    _replace(snapshot_path(name, 'npy'), lambda f: np.save(f, np.concatenate([header, np.asarray(values, dtype=np.float64)])))
+
+
+def load_series(name):
+    path = snapshot_path(name, 'npy')
+    try:
+        _record_mtime(path)
+        series = np.load(path, mmap_mode='r')
+    except FileNotFoundError:
+        return None, None, None
+    except Exception as e:
+        print(f"Failed to load snapshot {path}: {e}")
+        return None, None, None
+    if len(series) < 3 or int(series[0]) != SNAPSHOT_FORMAT:
+        print(f"Ignoring snapshot {path} with an unknown format")
+        return None, None, None
+    return int(series[2]), series[3:], float(series[1])
+
+
+def save_json(name, data, fetched_at=None):
+    payload = {'format': SNAPSHOT_FORMAT, 'fetched_at': fetched_at or time.time(), 'data': data}
+    _replace(snapshot_path(name, 'json'), lambda f: f.write(json.dumps(payload, separators=(',', ':')).encode()))
+
+
+def load_json(name):
+    path = snapshot_path(name, 'json')
+    try:
+        _record_mtime(path)
+        with open(path, 'rb') as f:
+            payload = json.load(f)
+    except FileNotFoundError:
+        return None, None
+    except Exception as e:
+        print(f"Failed to load snapshot {path}: {e}")
+        return None, None
+    if payload.get('format') != SNAPSHOT_FORMAT:
+        print(f"Ignoring snapshot {path} with format {payload.get('format')}")
+        return None, None
+    return payload['data'], payload['fetched_at']
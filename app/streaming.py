@@ -0,0 +1,76 @@
+import json
+from flask import Response, request, stream_with_context
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+from .models import Data
+from .queries import SLIM_COLUMNS, DESCRIPTION_COLUMNS
+from .utils import transform_data
+from .admission import pricing_slots
+
+
+NDJSON_MIMETYPE = 'application/x-ndjson'
+STREAM_BATCH = 500
+
+
+def wants_ndjson():
+    if request.args.get('format') == 'ndjson':
+        return True
+    return request.accept_mimetypes.best == NDJSON_MIMETYPE
+
+
+def encode_line(obj):
+    if orjson is not None:
+        return orjson.dumps(obj) + b'\n'
+    return (json.dumps(obj, separators=(',', ':')) + '\n').encode()
+
+
+def group_line(key, group):
+    return encode_line({'key': key, 'name': group['name'], 'prijsonderdelen': group['prijsonderdelen']})
+
+
+def stream_groups(groups):
+    return Response((group_line(key, group) for key, group in groups.items()), mimetype=NDJSON_MIMETYPE)
+
+
+def stream_query(query, context, show_prices=False):
+    # One line per product, written while the cursor is consumed in batches. Rows come ordered by
+    # productnaam so a product's rows are contiguous; only the product still being read is held back.
+    # The descriptions are part of the projection: a second query on the connection would make pymysql
+    # discard the rest of the unbuffered result.
+    columns = [getattr(Data, name) for name in SLIM_COLUMNS + DESCRIPTION_COLUMNS]
+    rows = query.order_by(Data.productnaam, Data.id).with_entities(*columns).yield_per(STREAM_BATCH)
+
+    def batches():
+        batch = []
+        for row in rows:
+            batch.append(row._asdict())
+            if len(batch) == STREAM_BATCH:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def generate():
+        pending = None
+        for batch in batches():
+            if show_prices:
+                # A pricing slot per batch, so a slow reader doesn't hold one while the body is written
+                with pricing_slots:
+                    groups = transform_data(batch, show_prices=show_prices, context=context)
+            else:
+                groups = transform_data(batch, show_prices=show_prices, context=context)
+            for key, group in groups.items():
+                if pending is not None and pending[0] == key:
+                    pending[1]['prijsonderdelen'].extend(group['prijsonderdelen'])
+                    continue
+                if pending is not None:
+                    yield group_line(*pending)
+                pending = (key, group)
+        if pending is not None:
+            yield group_line(*pending)
+
+    return Response(stream_with_context(generate()), mimetype=NDJSON_MIMETYPE)
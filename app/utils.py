@@ -1,18 +1,13 @@
 import os
-import pandas as pd
 import re
+from io import BytesIO
 from dotenv import load_dotenv
-from datetime import datetime, timedelta, timezone
 
-from .entsoe import get_entsoe_data
-from .netkosten import get_cost_from_zip
+from .pricing import price_rows, pricing_context
+from .price_cache import get_cached_prices
+from .metrics import span
 
 
-BIJZ_ACCIJNS = 1.4121
-BIJDRAGE_ENERGIE = 0.1926
-AANSLUITINGSVERGOEDING = 0.075
-afname_regio = 0
-
 def normalize_column_name(name, rename_map):
     name = name.lower()  # Convert to lowercase
     name = re.sub(r'[\s\/]', '_', name)  # Replace spaces and slashes with underscores
@@ -28,23 +23,77 @@ rename_map = {
     'waarde_y__mwh__laatst_gekende_waarde': 'waarde_y_laatst_gekende'
 }
 
-def fetch_data():
+MONTHS = {
+    'jan': 1, 'feb': 2, 'mrt': 3, 'maa': 3, 'apr': 4, 'mei': 5, 'jun': 6,
+    'jul': 7, 'aug': 8, 'sep': 9, 'okt': 10, 'nov': 11, 'dec': 12
+}
+
+def month_key(jaar, maand):
+    # (year, month number) for ordering, or None when the month isn't recognised
+    maand = str(maand).strip().lower()
+    if maand.isdigit():
+        return (int(jaar), int(maand))
+    if maand[:3] in MONTHS:
+        return (int(jaar), MONTHS[maand[:3]])
+    return None
+
+def open_workbook(source):
+    # The Excel and download dependencies are only imported by the import paths
+    import openpyxl
+    import requests
+    if source.startswith(('http://', 'https://')):
+        response = requests.get(source, timeout=120)
+        response.raise_for_status()
+        source = BytesIO(response.content)
+    return openpyxl.load_workbook(source, read_only=True, data_only=True)
+
+def read_vreg_months(source, since=None):
+    # Stream the second and third sheets row by row, grouped per (jaar, maand).
+    # With `since`, rows of months before that (year, month) are skipped without being kept.
+    workbook = open_workbook(source)
+    months = {}
+    try:
+        for sheet in workbook.worksheets[1:3]:
+            rows = sheet.iter_rows(values_only=True)
+            header = next(rows, None)
+            if header is None:
+                continue
+            columns = [normalize_column_name(str(col), rename_map) if col is not None else None for col in header]
+            jaar_index = columns.index('jaar')
+            maand_index = columns.index('maand')
+
+            for values in rows:
+                jaar = values[jaar_index] if jaar_index < len(values) else None
+                if jaar is None or str(jaar).strip() == '':
+                    continue
+                try:
+                    jaar = str(int(float(jaar)))
+                except ValueError:
+                    # Notes or totals under the table; one such cell shouldn't cost the whole workbook
+                    continue
+                maand = values[maand_index] if maand_index < len(values) else None
+                maand = str(maand).strip() if maand is not None else None
+                if since is not None:
+                    key = month_key(jaar, maand)
+                    if key is not None and key < since:
+                        continue
+
+                row = {col: value for col, value in zip(columns, values) if col}
+                row['jaar'] = jaar
+                row['maand'] = maand
+                months.setdefault((jaar, maand), []).append(row)
+    finally:
+        workbook.close()
+    return months
+
+def fetch_data(since=None):
+    import pandas as pd
     load_dotenv()
     src_url = os.getenv('SRC_URL')
     if src_url:
         try:
-            # Read the second and third sheets of the Excel file from the URL
-            data_sheet_2 = pd.read_excel(src_url, sheet_name=1)
-            data_sheet_3 = pd.read_excel(src_url, sheet_name=2)
-
-            # Normalize the column names
-            data_sheet_2.columns = [normalize_column_name(col, rename_map) for col in data_sheet_2.columns]
-            data_sheet_3.columns = [normalize_column_name(col, rename_map) for col in data_sheet_3.columns]
-
-            # Append the data from the third sheet to the second sheet
-            combined_data = pd.concat([data_sheet_2, data_sheet_3], ignore_index=True)
-
-            return combined_data
+            months = read_vreg_months(src_url, since)
+            return pd.DataFrame([row for rows in months.values() for row in rows])
         except Exception as e:
             print(f"An error occurred: {e}")
             return pd.DataFrame()
@@ -53,17 +102,18 @@ def fetch_data():
         return pd.DataFrame()
 
 
-def transform_data(filtered_data, show_prices = False, afname_regio_val = None):
-    global afname_regio
-    afname_regio = afname_regio_val
+def transform_data(filtered_data, show_prices = False, context = None, compact = False):
+    # `context` is the request's PricingContext; nothing about the request is kept in module state
+    if show_prices:
+        with span('prices'):
+            priced = get_cached_prices(filtered_data, context or pricing_context(), compact=compact)
+        for row, prices in zip(filtered_data, priced):
+            row["prices"] = prices
 
     grouped_data = {}
     for row in filtered_data:
         productnaam_key = re.sub(r'[^a-z0-9_]', '', re.sub(r'\s+', '_', row['productnaam'].lower()))
 
-        if show_prices:
-            row["prices"] = set_prices(row)
-
         if productnaam_key not in grouped_data:
             grouped_data[productnaam_key] = {
                 'name': row['productnaam'],
@@ -74,121 +124,5 @@ def transform_data(filtered_data, show_prices = False, afname_regio_val = None):
     return grouped_data
 
 
-def set_prices(data):
-    specific_date = datetime.now().replace(tzinfo=timezone(timedelta(hours=2)))
-
-    prices = {}
-    prices["prices_today"] = []
-    prices["prices_tomorrow"] = []
-    prices["prices_next24h"] = []
-
-    if data["vast_variabel_dynamisch"] == "Dynamisch":
-        for i in range(24):
-            specific_time = specific_date.replace(hour=i, minute=0, second=0, microsecond=0).strftime('%Y-%m-%dT%H:00:00%z')
-            prices_today = calculate_price(data, "dyn", time=specific_time)
-            prices["prices_today"].append({
-                "time": specific_time,
-                "price": prices_today
-                })
-
-            specific_time_tomorrow = (specific_date + timedelta(days=1)).replace(hour=i, minute=0, second=0, microsecond=0).strftime('%Y-%m-%dT%H:00:00%z')
-            prices_tomorrow = calculate_price(data, "dyn", time=specific_time_tomorrow) if datetime.now().hour >= 12 else 0
-            prices["prices_tomorrow"].append({
-                "time": specific_time_tomorrow,
-                "price": prices_tomorrow
-                })
-
-    if data["vast_variabel_dynamisch"] == "Variabel":
-        for i in range(24):
-            specific_time = specific_date.replace(hour=i, minute=0, second=0, microsecond=0)
-            prices_today = calculate_price(data, "var")
-            prices["prices_today"].append({
-                "time": specific_time.strftime('%Y-%m-%dT%H:00:00%z'),
-                "price": prices_today
-                })
-
-            specific_time_tomorrow = (specific_date + timedelta(days=1)).replace(hour=i, minute=0, second=0, microsecond=0)
-            prices_tomorrow = calculate_price(data, "var") if datetime.now().hour >= 12 else 0
-            prices["prices_tomorrow"].append({
-                "time": specific_time_tomorrow.strftime('%Y-%m-%dT%H:00:00%z'),
-                "price": prices_tomorrow
-                })
-
-    if data["vast_variabel_dynamisch"] == "Vast":
-        for i in range(24):
-            specific_time = specific_date.replace(hour=i, minute=0, second=0, microsecond=0)
-            prices_today = calculate_price(data, "vast")
-            prices["prices_today"].append({
-                "time": specific_time.strftime('%Y-%m-%dT%H:00:00%z'),
-                "price": prices_today
-                })
-
-            specific_time_tomorrow = (specific_date + timedelta(days=1)).replace(hour=i, minute=0, second=0, microsecond=0)
-            prices_tomorrow = calculate_price(data, "vast") if datetime.now().hour >= 12 else 0
-            prices["prices_tomorrow"].append({
-                "time": specific_time_tomorrow.strftime('%Y-%m-%dT%H:00:00%z'),
-                "price": prices_tomorrow
-                })
-    
-    current_hour = specific_date.hour
-
-    for i in range(24):
-        if i + current_hour < 24:
-            specific_time_next24h = specific_date.replace(hour=(i + current_hour) % 24, minute=0, second=0, microsecond=0).strftime('%Y-%m-%dT%H:00:00%z')
-            prices_next24h = prices["prices_today"][(i + current_hour) % 24]["price"]
-        else:
-            specific_time_next24h = (specific_date + timedelta(days=1)).replace(hour=(i + current_hour) % 24, minute=0, second=0, microsecond=0).strftime('%Y-%m-%dT%H:00:00%z')
-            prices_next24h = prices["prices_tomorrow"][(i + current_hour) % 24]["price"]
-        prices["prices_next24h"].append({
-            "time": specific_time_next24h,
-            "price": prices_next24h
-        })
-
-    prices["today_min"] = min(p["price"] for p in prices["prices_today"])
-    prices["today_max"] = max(p["price"] for p in prices["prices_today"])
-    prices["today_avg"] = sum(p["price"] for p in prices["prices_today"]) / len(prices["prices_today"])
-
-    prices["tomorrow_min"] = min(p["price"] for p in prices["prices_tomorrow"])
-    prices["tomorrow_max"] = max(p["price"] for p in prices["prices_tomorrow"])
-    prices["tomorrow_avg"] = sum(p["price"] for p in prices["prices_tomorrow"]) / len(prices["prices_tomorrow"])
-
-    prices["next24h_min"] = min(p["price"] for p in prices["prices_next24h"])
-    prices["next24h_max"] = max(p["price"] for p in prices["prices_next24h"])
-    prices["next24h_avg"] = sum(p["price"] for p in prices["prices_next24h"]) / len(prices["prices_next24h"])
-
-    return prices
-
-
-def calculate_price(data, type, time=None):
-    global afname_regio
-    price = 0
-    if type == "var":
-        if data["prijs"]:
-            price = data["prijs"]
-        
-        elif data["a"] and data["waarde_x_laatst_gekende"]:
-            price = float(data["a"]) * float(data["waarde_x_laatst_gekende"]) + data["d"]
-        
-    if type == "vast":
-        price = data["prijs"]
-    
-    if type == "dyn":
-        if data["prijs"]:
-            price = data["prijs"]
-        
-        if data["a"] and data["d"]:
-            entsoe_data = get_entsoe_data()
-            for row in entsoe_data:
-                if row["start"] == time:
-                    price = float(data["a"]) * float(row["price"]) + data["d"]
-                    # print(f'{data["productnaam"]} {data["contracttype"]}: {float(data["a"])} * {float(row["price"])} + {data["d"]} = {price}')
-    
-    if data["contracttype"] == "Afname" and data["energietype"] == "Elektriciteit":
-        price *= 1.06
-        try:
-            price += data["groene_stroom"] + data["wkk"] + BIJZ_ACCIJNS + BIJDRAGE_ENERGIE + AANSLUITINGSVERGOEDING + afname_regio
-        except:
-            print(f"Error with {data['productnaam']}")
-
-    price = round(price, 6)
-    return price
+def set_prices(data, context):
+    return price_rows([data], context)[0]
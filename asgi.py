@@ -0,0 +1,7 @@
+import os
+from a2wsgi import WSGIMiddleware
+from run import build_app
+
+# Production entry point: uvicorn asgi:application --host 0.0.0.0 --port 5000
+# Requests run on a bounded thread pool; show_prices work is further limited by app.admission.
+application = WSGIMiddleware(build_app(), workers=int(os.getenv('SERVER_THREADS', 16)))
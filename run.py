@@ -1,12 +1,22 @@
-from app import create_app
-from app.routes import init_routes
 from dotenv import load_dotenv
+import os
 
 load_dotenv('.env')
 load_dotenv('secret.env')
 
-app = create_app()
-init_routes(app)
+
+def build_app():
+    from app import create_app
+    from app.routes import init_routes
+    app = create_app()
+    init_routes(app)
+    return app
+
 
 if __name__ == '__main__':
-    app.run(debug=True, host='0.0.0.0')
+    if os.getenv('SERVER_MODE') == 'asgi':
+        # Each uvicorn worker builds the app through asgi.py; this supervisor process only manages them
+        import uvicorn
+        uvicorn.run('asgi:application', host='0.0.0.0', port=5000, workers=int(os.getenv('SERVER_WORKERS', 1)))
+    else:
+        build_app().run(debug=True, host='0.0.0.0')
@@ -0,0 +1,263 @@
+# Offline benchmarks for the pricing and import hot paths.
+#
+#   python scripts/benchmark.py --sizes 1000,10000,100000 --output benchmark.json
+#   python scripts/benchmark.py --baseline benchmark.json
+#
+# Runs on synthetic VREG-shaped rows, generated ENTSO-E/Fluvius fixtures (or recorded ones from
+# --fixtures DIR: entsoe.xml, tariff.xlsx, zipcodes.json) and a throwaway SQLite database.
+# Nothing goes over the network. Times are the median of --repeat runs; memory is the
+# tracemalloc peak of one extra run.
+import os
+import sys
+import io
+import json
+import time
+import random
+import sqlite3
+import argparse
+import tempfile
+import statistics
+import tracemalloc
+from datetime import datetime, timedelta, timezone
+
+import openpyxl
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+REGIONS = ['Fluvius Antwerpen', 'Fluvius Limburg', 'Fluvius West', 'Gaselwest', 'Imewo',
+           'Intergem', 'Iveka', 'Iverlek', 'Pbe', 'Sibelgas']
+ENTSOE_DAYS = 365
+DEFAULT_SIZES = '1000,10000,100000'
+
+
+def vreg_rows(size, seed=42):
+    # `size` product rows that stay rows in the data table, plus the WKK / groene stroom / vaste
+    # vergoeding rows the importer merges onto the Afname Elektriciteit products
+    rng = random.Random(seed)
+    rows = []
+    products = (size + 1) // 2
+    for p in range(products):
+        kind = ('Vast', 'Variabel', 'Dynamisch')[p % 3]
+        product = {
+            'jaar': '2024', 'maand': 'jan', 'handelsnaam': f'Leverancier {p % 40}', 'productnaam': f'Product {p}',
+            'segment': 'Residentieel', 'energietype': 'Elektriciteit' if p % 4 else 'Aardgas',
+            'contracttype': 'Afname' if p % 5 else 'Injectie', 'vast_variabel_dynamisch': kind,
+            'indexatieparameter_x': 'Belpex' if kind != 'Vast' else None,
+        }
+        for part in ('Energieprijs dag', 'Energieprijs nacht')[:2 if 2 * p + 1 < size else 1]:
+            rows.append(dict(product, prijsonderdeel=part,
+                             beschrijving_x='Indexatie op het gemiddelde van de dagprijzen ' * 4,
+                             a=round(rng.uniform(0.08, 0.12), 4) if kind != 'Vast' else None,
+                             d=round(rng.uniform(0.5, 2), 4) if kind != 'Vast' else None,
+                             prijs=round(rng.uniform(8, 30), 4) if kind != 'Dynamisch' else None,
+                             waarde_x_laatst_gekende=round(rng.uniform(60, 120), 2) if kind == 'Variabel' else None))
+        if product['contracttype'] == 'Afname' and product['energietype'] == 'Elektriciteit':
+            rows.append(dict(product, prijsonderdeel='Bijdrage WKK', prijs=round(rng.uniform(1, 2), 4)))
+            rows.append(dict(product, prijsonderdeel='Bijdrage groene stroom', prijs=round(rng.uniform(1, 3), 4)))
+            rows.append(dict(product, prijsonderdeel='Vaste vergoeding (€/jaar)', prijs=round(rng.uniform(40, 120), 2)))
+    return rows
+
+
+def vreg_workbook(rows):
+    # Same layout as the VREG export: the data on the second sheet
+    columns = sorted({key for row in rows for key in row})
+    workbook = openpyxl.Workbook(write_only=True)
+    workbook.create_sheet('Info')
+    sheet = workbook.create_sheet('Data')
+    sheet.append(columns)
+    for row in rows:
+        sheet.append([row.get(column) for column in columns])
+    buffer = io.BytesIO()
+    workbook.save(buffer)
+    return buffer.getvalue()
+
+
+def entsoe_document(days=ENTSOE_DAYS):
+    # A day-ahead price document at 15-minute resolution, one Period per day
+    start = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=days - 2, hours=2)
+    periods = []
+    for day in range(days):
+        day_start = start + timedelta(days=day)
+        points = ''.join(f'<Point><position>{i}</position><price.amount>{40 + (day * 7 + i) % 90}.25</price.amount></Point>'
+                         for i in range(1, 97))
+        periods.append(f'<Period><timeInterval><start>{day_start:%Y-%m-%dT%H:%MZ}</start>'
+                       f'<end>{day_start + timedelta(days=1):%Y-%m-%dT%H:%MZ}</end></timeInterval>'
+                       f'<resolution>PT15M</resolution>{points}</Period>')
+    return ('<?xml version="1.0" encoding="UTF-8"?><Publication_MarketDocument '
+            'xmlns="urn:iec62325.351:tc57wg16:451-3:publicationdocument:7:3"><TimeSeries>'
+            + ''.join(periods) + '</TimeSeries></Publication_MarketDocument>').encode()
+
+
+def tariff_workbook():
+    # Monthly grid costs where the Fluvius workbooks keep them: rows 47-58, column Q
+    frame = pd.DataFrame([[None] * 17 for _ in range(60)])
+    for month in range(12):
+        frame.iloc[45 + month, 16] = 0.1 + month / 100
+    buffer = io.BytesIO()
+    frame.to_excel(buffer, index=False)
+    return buffer.getvalue()
+
+
+def zipcodes():
+    return [{'postcode': str(postcode), 'dnb_elektriciteit': REGIONS[postcode % len(REGIONS)]} for postcode in range(1000, 10000, 10)]
+
+
+def load_fixtures(directory):
+    fixtures = {'entsoe': None, 'tariff': None, 'zipcodes': None}
+    if directory:
+        for name, filename in (('entsoe', 'entsoe.xml'), ('tariff', 'tariff.xlsx')):
+            path = os.path.join(directory, filename)
+            if os.path.exists(path):
+                with open(path, 'rb') as f:
+                    fixtures[name] = f.read()
+        path = os.path.join(directory, 'zipcodes.json')
+        if os.path.exists(path):
+            with open(path) as f:
+                fixtures['zipcodes'] = json.load(f)
+    fixtures['entsoe'] = fixtures['entsoe'] or entsoe_document()
+    fixtures['tariff'] = fixtures['tariff'] or tariff_workbook()
+    fixtures['zipcodes'] = fixtures['zipcodes'] or zipcodes()
+    return fixtures
+
+
+def measure(stage, size, items, run, repeat):
+    run()  # warm-up
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - started)
+    tracemalloc.start()
+    run()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    seconds = statistics.median(times)
+    result = {'stage': stage, 'size': size, 'items': items, 'seconds': seconds,
+              'throughput': items / seconds if seconds else None, 'peak_mb': peak / 2 ** 20}
+    print(f"{stage:<22}{size:>8}{seconds * 1000:>12.2f} ms{result['throughput'] or 0:>14.0f}/s{result['peak_mb']:>10.1f} MB")
+    return result
+
+
+def run_benchmarks(sizes, repeat, fixtures, workdir):
+    # The app reads its configuration at import time, so it is only imported once the
+    # snapshot directory and database for this run are in place
+    os.environ['SNAPSHOT_DIR'] = os.path.join(workdir, 'snapshots')
+    os.environ['DATABASE_URI'] = 'sqlite:///' + os.path.join(workdir, 'benchmark.sqlite')
+    os.environ['REFRESH_MODE'] = 'shared'
+    os.environ['ENTSOE_ZONES'] = 'BE'
+    os.environ['RESPONSE_CACHE_MAX_BYTES'] = '0'
+
+    from app.entsoe import parse_entsoe_data, HourlyPrices, publish_entsoe_prices
+    from app.netkosten import parse_tariff_workbook, publish_netkosten, get_cost_from_zip
+    from app.snapshots import save_series, save_json
+    from app.pricing import pricing_context, to_columns, spot_prices, price_matrix, price_rows
+    from app.utils import read_vreg_months, transform_data
+    from scripts.data_to_mysql import prepare_data, merge_price_components, import_data
+
+    results = []
+    print(f"{'stage':<22}{'size':>8}{'median':>15}{'throughput':>16}{'peak':>13}")
+
+    hours, prices = parse_entsoe_data(io.BytesIO(fixtures['entsoe']))
+    results.append(measure('entsoe_parse', len(hours), len(hours), lambda: parse_entsoe_data(io.BytesIO(fixtures['entsoe'])), repeat))
+    tariff = parse_tariff_workbook(fixtures['tariff'])
+    results.append(measure('tariff_parse', 1, 1, lambda: parse_tariff_workbook(fixtures['tariff']), repeat))
+
+    store = HourlyPrices().merged(hours, prices)
+    publish_entsoe_prices(store, time.time())
+    save_series('entsoe', store.first_hour, store.prices)
+    zip_regions = {row['postcode']: row['dnb_elektriciteit'] for row in fixtures['zipcodes']}
+    tarieven = {region: tariff for region in REGIONS}
+    publish_netkosten(zip_regions, tarieven, time.time())
+    save_json('netkosten', {'zipcodes': zip_regions, 'tarieven': tarieven, 'validators': {}})
+
+    from app import create_app, db
+    from app.routes import init_routes
+    from app.price_cache import check_import
+    from app.queries import slim_rows
+    from app.models import Data
+    app = None
+
+    for size in sizes:
+        raw = vreg_rows(size)
+        workbook = os.path.join(workdir, f'vreg-{size}.xlsx')
+        with open(workbook, 'wb') as f:
+            f.write(vreg_workbook(raw))
+        results.append(measure('vreg_read', size, len(raw), lambda: read_vreg_months(workbook), repeat))
+        frame = pd.DataFrame(raw)
+        results.append(measure('import_merge', size, len(raw), lambda: merge_price_components(prepare_data(frame)), repeat))
+
+        def import_sqlite():
+            connection = sqlite3.connect(os.path.join(workdir, 'benchmark.sqlite'))
+            connection.execute('DROP TABLE IF EXISTS data')
+            import_data(connection, frame)
+            connection.close()
+        results.append(measure('import_sqlite', size, len(raw), import_sqlite, repeat))
+
+        if app is None:
+            app = create_app()
+            init_routes(app)
+        check_import(app)
+        with app.app_context():
+            rows = slim_rows(Data.query)
+            db.session.remove()
+        count = len(rows)
+
+        context = pricing_context('1040')
+        results.append(measure('calculate_price', size, count, lambda: price_matrix(to_columns(rows), spot_prices(context)), repeat))
+        results.append(measure('set_prices', size, count, lambda: price_rows(rows, context), repeat))
+        results.append(measure('transform_data', size, count,
+                               lambda: transform_data([dict(row) for row in rows], show_prices=True, context=context), repeat))
+        postcodes = [str(1000 + 10 * (i % 900)) for i in range(count)]
+        results.append(measure('get_cost_from_zip', size, count, lambda: [get_cost_from_zip(postcode) for postcode in postcodes], repeat))
+
+        client = app.test_client()
+        for stage, url in (('data_request', '/data?show_prices=1&postcode=9000'),
+                           ('data_request_compact', '/data?show_prices=1&postcode=9000&format=compact')):
+            results.append(measure(stage, size, count, lambda: client.get(url).get_data(), repeat))
+    return results
+
+
+def compare(results, baseline, threshold):
+    # Slower than the baseline by more than `threshold` (fraction of its time) counts as a regression
+    known = {(result['stage'], result['size']): result for result in baseline}
+    regressions = 0
+    print(f"\n{'stage':<22}{'size':>8}{'baseline':>12}{'now':>12}{'change':>10}")
+    for result in results:
+        previous = known.get((result['stage'], result['size']))
+        if previous is None:
+            continue
+        change = result['seconds'] / previous['seconds'] - 1 if previous['seconds'] else 0
+        flag = '  REGRESSION' if change > threshold else ''
+        regressions += bool(flag)
+        print(f"{result['stage']:<22}{result['size']:>8}{previous['seconds'] * 1000:>10.2f}ms"
+              f"{result['seconds'] * 1000:>10.2f}ms{change:>+10.1%}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline benchmarks for the pricing and import hot paths')
+    parser.add_argument('--sizes', default=DEFAULT_SIZES, help='comma-separated numbers of data rows')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--fixtures', help='directory with recorded entsoe.xml, tariff.xlsx and zipcodes.json')
+    parser.add_argument('--output', help='write the results as JSON, e.g. to keep as a baseline')
+    parser.add_argument('--baseline', help='compare against the results of an earlier --output run')
+    parser.add_argument('--threshold', type=float, default=0.1, help='allowed slowdown against the baseline')
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(',') if size]
+    with tempfile.TemporaryDirectory() as workdir:
+        results = run_benchmarks(sizes, args.repeat, load_fixtures(args.fixtures), workdir)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'created_at': datetime.now().isoformat(), 'results': results}, f, indent=1)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
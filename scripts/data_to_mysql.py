@@ -1,8 +1,14 @@
 import os
+import re
+import sys
+import json
+import hashlib
 import pandas as pd
 import mysql.connector
+import sqlite3
 from dotenv import load_dotenv
-from app.utils import normalize_column_name, rename_map
+from app.utils import read_vreg_months, month_key
+from app.queries import NORMALIZE_JAAR
 
 load_dotenv()
 
@@ -14,33 +20,17 @@ db_config = {
     'database': os.getenv('DB_NAME')
 }
 
-def fetch_data():
+def fetch_months(since=None):
     src_url = os.getenv('SRC_URL')
     if src_url:
         try:
-            # Read the second and third sheets of the Excel file from the URL
-            data_sheet_2 = pd.read_excel(src_url, sheet_name=1)
-            data_sheet_3 = pd.read_excel(src_url, sheet_name=2)
-
-            # Normalize the column names
-            data_sheet_2.columns = [normalize_column_name(col, rename_map) for col in data_sheet_2.columns]
-            data_sheet_3.columns = [normalize_column_name(col, rename_map) for col in data_sheet_3.columns]
-
-            # Append the data from the third sheet to the second sheet
-            combined_data = pd.concat([data_sheet_2, data_sheet_3], ignore_index=True)
-
-            # Drop rows where 'Jaar' value is empty
-            combined_data = combined_data.dropna(subset=['jaar'])
-
-            return combined_data
+            return read_vreg_months(src_url, since)
         except Exception as e:
             print(f"An error occurred: {e}")
-            return pd.DataFrame()
+            return {}
     else:
         print("SRC_URL is not set in the .env file.")
-        return pd.DataFrame()
-
-data = fetch_data()
+        return {}
 
 # Define possible columns and their default values
 columns_with_defaults = {
@@ -51,77 +41,20 @@ columns_with_defaults = {
     'c': None, 'd': None, 'prijs': None
 }
 
-# Reorder and fill DataFrame columns
-for col in columns_with_defaults:
-    if col not in data.columns:
-        data[col] = columns_with_defaults[col]
-
-data = data[list(columns_with_defaults.keys())]
-
-# Convert NaN to None and ensure correct data types
-data = data.where(pd.notnull(data), None)
-
-# Separate rows with "WKK", "groene stroom", and "Vaste vergoeding" in 'prijsonderdeel'
-wkk_rows = data[data['prijsonderdeel'].str.contains("WKK", na=False)]
-groene_stroom_rows = data[data['prijsonderdeel'].str.contains("groene stroom", na=False)]
-vaste_vergoeding_rows = data[data['prijsonderdeel'].str.contains("Vaste vergoeding", na=False)]
-
-# Remove "WKK", "groene stroom", and "Vaste vergoeding" rows from the original data
-data = data[~data['prijsonderdeel'].str.contains("WKK|groene stroom|Vaste vergoeding", na=False)]
-
-# Create columns for wkk, groene_stroom, and various vaste_vergoeding columns
-data['wkk'] = None
-data['groene_stroom'] = None
-data['vaste_vergoeding'] = None
-data['vaste_vergoeding_enkelvoudige_meter'] = None
-data['vaste_vergoeding_tweevoudige_meter'] = None
-data['vaste_vergoeding_uitsluitend_nachttarief'] = None
-
-# Aggregate wkk and groene stroom values
-for _, row in wkk_rows.iterrows():
-    match = (data['segment'] == row['segment']) & \
-            (data['energietype'] == row['energietype']) & \
-            (data['contracttype'] == row['contracttype']) & \
-            (data['handelsnaam'] == row['handelsnaam']) & \
-            (data['productnaam'] == row['productnaam']) & \
-            (data['jaar'] == row['jaar']) & \
-            (data['maand'] == row['maand'])
-    data.loc[match, 'wkk'] = row['prijs']
-
-for _, row in groene_stroom_rows.iterrows():
-    match = (data['segment'] == row['segment']) & \
-            (data['energietype'] == row['energietype']) & \
-            (data['contracttype'] == row['contracttype']) & \
-            (data['handelsnaam'] == row['handelsnaam']) & \
-            (data['productnaam'] == row['productnaam']) & \
-            (data['jaar'] == row['jaar']) & \
-            (data['maand'] == row['maand'])
-    data.loc[match, 'groene_stroom'] = row['prijs']
-
-# Aggregate vaste_vergoeding values
-for _, row in vaste_vergoeding_rows.iterrows():
-    col_name = row['prijsonderdeel'].lower().replace(' ', '_').replace('_(', '').replace(')', '').replace('€', '').replace('__', '_').strip()
-    if col_name not in data.columns:
-        continue
-    match = (data['segment'] == row['segment']) & \
-            (data['energietype'] == row['energietype']) & \
-            (data['contracttype'] == row['contracttype']) & \
-            (data['handelsnaam'] == row['handelsnaam']) & \
-            (data['productnaam'] == row['productnaam']) & \
-            (data['jaar'] == row['jaar']) & \
-            (data['maand'] == row['maand'])
-    data.loc[match, col_name] = row['prijs']
-
-# Function to handle row conversion
-def convert_row(row):
-    # Convert row to list and replace any NaN with None
-    return [None if pd.isna(x) else x for x in row]
-
-# Connect to MySQL and insert data
-conn = mysql.connector.connect(**db_config)
-cursor = conn.cursor()
-
-# Create table if not exists
+# Price components that are stored as columns on the product row they belong to
+component_columns = [
+    'wkk', 'groene_stroom', 'vaste_vergoeding', 'vaste_vergoeding_enkelvoudige_meter',
+    'vaste_vergoeding_tweevoudige_meter', 'vaste_vergoeding_uitsluitend_nachttarief'
+]
+
+merge_keys = ['segment', 'energietype', 'contracttype', 'handelsnaam', 'productnaam', 'jaar', 'maand']
+
+table_columns = list(columns_with_defaults.keys()) + component_columns
+
+unique_columns = ['jaar', 'maand', 'handelsnaam', 'productnaam', 'prijsonderdeel']
+
+BATCH_SIZE = 1000
+
 create_table_query = '''
 CREATE TABLE IF NOT EXISTS data (
     id INT AUTO_INCREMENT PRIMARY KEY,
@@ -153,58 +86,211 @@ CREATE TABLE IF NOT EXISTS data (
     vaste_vergoeding_enkelvoudige_meter FLOAT,
     vaste_vergoeding_tweevoudige_meter FLOAT,
     vaste_vergoeding_uitsluitend_nachttarief FLOAT,
-    UNIQUE (jaar, maand, handelsnaam, productnaam, prijsonderdeel)
+    UNIQUE (jaar, maand, handelsnaam, productnaam, prijsonderdeel),
+    INDEX ix_data_period_type (jaar, maand, vast_variabel_dynamisch, energietype),
+    INDEX ix_data_type (vast_variabel_dynamisch, energietype, contracttype)
 );
 '''
-cursor.execute(create_table_query)
-
-# Insert data into the table
-insert_query = '''
-INSERT INTO data (jaar, maand, handelsnaam, productnaam, segment, energietype, contracttype, vast_variabel_dynamisch,
-    prijsonderdeel, indexatieparameter_x, indexatieparameter_y, beschrijving_x, beschrijving_y,
-    waarde_x_vreg, waarde_y_vreg, waarde_x_laatst_gekende, waarde_y_laatst_gekende, a, b, c, d, prijs, wkk, groene_stroom, 
-    vaste_vergoeding, vaste_vergoeding_enkelvoudige_meter, vaste_vergoeding_tweevoudige_meter, vaste_vergoeding_uitsluitend_nachttarief)
-VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-ON DUPLICATE KEY UPDATE
-    segment=VALUES(segment),
-    energietype=VALUES(energietype),
-    contracttype=VALUES(contracttype),
-    vast_variabel_dynamisch=VALUES(vast_variabel_dynamisch),
-    indexatieparameter_x=VALUES(indexatieparameter_x),
-    indexatieparameter_y=VALUES(indexatieparameter_y),
-    beschrijving_x=VALUES(beschrijving_x),
-    beschrijving_y=VALUES(beschrijving_y),
-    waarde_x_vreg=VALUES(waarde_x_vreg),
-    waarde_y_vreg=VALUES(waarde_y_vreg),
-    waarde_x_laatst_gekende=VALUES(waarde_x_laatst_gekende),
-    waarde_y_laatst_gekende=VALUES(waarde_y_laatst_gekende),
-    a=VALUES(a),
-    b=VALUES(b),
-    c=VALUES(c),
-    d=VALUES(d),
-    prijs=VALUES(prijs),
-    wkk=VALUES(wkk),
-    groene_stroom=VALUES(groene_stroom),
-    vaste_vergoeding=VALUES(vaste_vergoeding),
-    vaste_vergoeding_enkelvoudige_meter=VALUES(vaste_vergoeding_enkelvoudige_meter),
-    vaste_vergoeding_tweevoudige_meter=VALUES(vaste_vergoeding_tweevoudige_meter),
-    vaste_vergoeding_uitsluitend_nachttarief=VALUES(vaste_vergoeding_uitsluitend_nachttarief);
+
+create_import_log_query = '''
+CREATE TABLE IF NOT EXISTS import_log (
+    id INT AUTO_INCREMENT PRIMARY KEY,
+    imported_at DATETIME
+);
+'''
+
+# Content hash of every imported (jaar, maand); the newest month is the incremental high-water mark
+create_import_state_query = '''
+CREATE TABLE IF NOT EXISTS import_state (
+    jaar VARCHAR(10),
+    maand VARCHAR(12),
+    content_hash CHAR(64),
+    PRIMARY KEY (jaar, maand)
+);
 '''
 
-# Insert rows and log success or error
-for _, row in data.iterrows():
-    row_values = convert_row(row)
-    try:
-        cursor.execute(insert_query, row_values)
-    except Exception as e:
-        print(f"Error inserting row: {row_values}\nException: {e}")
+def prepare_data(data):
+    # Reorder and fill DataFrame columns
+    for col in columns_with_defaults:
+        if col not in data.columns:
+            data[col] = columns_with_defaults[col]
+    data = data[list(columns_with_defaults.keys())].copy()
+
+    # Store the year as "2024" rather than the "2024.0" a float column would give
+    data['jaar'] = pd.to_numeric(data['jaar'], errors='coerce').astype('Int64').astype(str).where(data['jaar'].notna(), None)
+    return data
+
+def vaste_vergoeding_column(prijsonderdeel):
+    return (prijsonderdeel.str.lower()
+            .str.replace(' ', '_', regex=False)
+            .str.replace('_(', '', regex=False)
+            .str.replace(')', '', regex=False)
+            .str.replace('€', '', regex=False)
+            .str.replace('__', '_', regex=False)
+            .str.strip())
+
+def merge_price_components(data):
+    prijsonderdeel = data['prijsonderdeel']
+    is_wkk = prijsonderdeel.str.contains("WKK", na=False)
+    is_groene_stroom = prijsonderdeel.str.contains("groene stroom", na=False)
+    is_vaste_vergoeding = prijsonderdeel.str.contains("Vaste vergoeding", na=False)
+
+    products = data[~(is_wkk | is_groene_stroom | is_vaste_vergoeding)].reset_index(drop=True)
+
+    # Long table of (product key, target column, value); rows with a missing key never matched a product
+    has_key = data[merge_keys].notna().all(axis=1)
+    components = pd.concat([
+        data.loc[is_wkk & has_key, merge_keys + ['prijs']].assign(column='wkk'),
+        data.loc[is_groene_stroom & has_key, merge_keys + ['prijs']].assign(column='groene_stroom'),
+        data.loc[is_vaste_vergoeding & has_key, merge_keys + ['prijs']].assign(column=vaste_vergoeding_column(prijsonderdeel[is_vaste_vergoeding & has_key])),
+    ])
+    components = components[components['column'].isin(component_columns)]
+
+    # When a product has the same component twice, the last row in the sheet wins
+    wide = (components.drop_duplicates(subset=merge_keys + ['column'], keep='last')
+            .pivot(index=merge_keys, columns='column', values='prijs')
+            .reindex(columns=component_columns)
+            .reset_index())
+    wide.columns.name = None
+
+    merged = products.merge(wide, on=merge_keys, how='left')
+    return merged[table_columns]
+
+def to_rows(data):
+    # Plain Python values with None for missing, as the database drivers expect
+    return data.astype(object).where(data.notna(), None).values.tolist()
+
+def upsert_query(connection):
+    columns = ', '.join(table_columns)
+    updates = [col for col in table_columns if col not in unique_columns]
+    if isinstance(connection, sqlite3.Connection):
+        placeholders = ', '.join(['?'] * len(table_columns))
+        assignments = ', '.join(f'{col}=excluded.{col}' for col in updates)
+        return f"INSERT INTO data ({columns}) VALUES ({placeholders}) ON CONFLICT ({', '.join(unique_columns)}) DO UPDATE SET {assignments}"
+    placeholders = ', '.join(['%s'] * len(table_columns))
+    assignments = ', '.join(f'{col}=VALUES({col})' for col in updates)
+    return f"INSERT INTO data ({columns}) VALUES ({placeholders}) ON DUPLICATE KEY UPDATE {assignments}"
+
+def load_rows(connection, rows):
+    # Returns the rows that could not be written
+    cursor = connection.cursor()
+    query = upsert_query(connection)
+    failed = []
+    for start in range(0, len(rows), BATCH_SIZE):
+        batch = rows[start:start + BATCH_SIZE]
+        try:
+            cursor.executemany(query, batch)
+        except Exception:
+            # Retry the batch row by row so only the bad rows are lost; the upsert makes rows
+            # that did go through harmless to write again
+            for row in batch:
+                try:
+                    cursor.execute(query, row)
+                except Exception as e:
+                    print(f"Error inserting row {row[:4] + row[8:9]}\nException: {e}")
+                    failed.append(row)
+    cursor.close()
+    return failed
+
+def for_connection(connection, query):
+    if isinstance(connection, sqlite3.Connection):
+        # SQLite has no inline INDEX clause; the app creates those indexes on startup
+        query = re.sub(r',\s*INDEX \w+ \([^)]*\)', '', query)
+        return query.replace('INT AUTO_INCREMENT PRIMARY KEY', 'INTEGER PRIMARY KEY AUTOINCREMENT')
+    return query
+
+def create_tables(connection):
+    cursor = connection.cursor()
+    cursor.execute(for_connection(connection, create_table_query))
+    cursor.execute(for_connection(connection, create_import_log_query))
+    cursor.execute(create_import_state_query)
+    cursor.close()
+
+def normalize_jaar(connection):
+    # Same statements the app runs from init_schema, for databases only this script touches
+    cursor = connection.cursor()
+    for statement in NORMALIZE_JAAR:
+        cursor.execute(statement)
+    cursor.close()
+    connection.commit()
+
+def placeholder(connection):
+    return '?' if isinstance(connection, sqlite3.Connection) else '%s'
+
+def month_hash(rows):
+    return hashlib.sha256(json.dumps(rows, sort_keys=True, default=str).encode()).hexdigest()
+
+def load_month_hashes(connection):
+    cursor = connection.cursor()
+    cursor.execute("SELECT jaar, maand, content_hash FROM import_state")
+    hashes = {(jaar, maand): content_hash for jaar, maand, content_hash in cursor.fetchall()}
+    cursor.close()
+    return hashes
+
+def high_water_mark(month_hashes):
+    keys = [month_key(jaar, maand) for jaar, maand in month_hashes]
+    keys = [key for key in keys if key is not None]
+    return max(keys) if keys else None
+
+def store_month_hashes(connection, month_hashes):
+    cursor = connection.cursor()
+    mark = placeholder(connection)
+    for (jaar, maand), content_hash in month_hashes.items():
+        cursor.execute(f"DELETE FROM import_state WHERE jaar = {mark} AND maand = {mark}", (jaar, maand))
+        cursor.execute(f"INSERT INTO import_state (jaar, maand, content_hash) VALUES ({mark}, {mark}, {mark})", (jaar, maand, content_hash))
+    cursor.close()
+
+def record_import(connection):
+    # Running app instances poll import_log and rebuild their price cache
+    cursor = connection.cursor()
+    cursor.execute("INSERT INTO import_log (imported_at) VALUES (CURRENT_TIMESTAMP)")
+    cursor.close()
+
+def import_data(connection, data, month_hashes=None):
+    rows = to_rows(merge_price_components(prepare_data(data)))
+    create_tables(connection)
+    failed = load_rows(connection, rows)
+    if month_hashes:
+        # Months with rows that failed to load are not recorded, so the next incremental run retries them
+        failed_months = {(row[0], row[1]) for row in failed}
+        if failed_months:
+            print(f"Not marking {len(failed_months)} month(s) as imported because of failed rows")
+        store_month_hashes(connection, {month: content_hash for month, content_hash in month_hashes.items()
+                                        if month not in failed_months})
+    record_import(connection)
+    connection.commit()
+    return len(rows)
+
+def import_months(connection, months, known_hashes=None):
+    # Only months whose content changed since the last import are merged and written
+    known_hashes = known_hashes or {}
+    hashes = {month: month_hash(rows) for month, rows in months.items()}
+    changed = [month for month in months if hashes[month] != known_hashes.get(month)]
+    if not changed:
+        print("No new or changed months to import.")
+        return 0
+    print(f"Importing {len(changed)} month(s): {', '.join(f'{maand} {jaar}' for jaar, maand in changed)}")
+    data = pd.DataFrame([row for month in changed for row in months[month]])
+    return import_data(connection, data, {month: hashes[month] for month in changed})
+
+def main():
+    conn = mysql.connector.connect(**db_config)
+    create_tables(conn)
+    normalize_jaar(conn)
+    if '--incremental' in sys.argv[1:]:
+        known_hashes = load_month_hashes(conn)
+        import_months(conn, fetch_months(high_water_mark(known_hashes)), known_hashes)
+    else:
+        import_months(conn, fetch_months())
 
-conn.commit()
+    # Verification query
+    cursor = conn.cursor()
+    cursor.execute("SELECT COUNT(*) FROM data")
+    row_count = cursor.fetchone()[0]
+    print(f"Number of rows in the table: {row_count}")
 
-# Verification query
-cursor.execute("SELECT COUNT(*) FROM data")
-row_count = cursor.fetchone()[0]
-print(f"Number of rows in the table: {row_count}")
+    cursor.close()
+    conn.close()
 
-cursor.close()
-conn.close()
+if __name__ == '__main__':
+    main()